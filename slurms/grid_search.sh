@@ -10,7 +10,7 @@
 
 module load anaconda3
 source .nflscraper_venv/bin/activate
-python src/grid_search_svm.py data/nfl2017_2023.csv
+python src/pipeline/grid_search_svm.py data/nfl2017_2023.csv --halving --results svm_grid_search.csv
 
 ## ** End Of SLURM Batch Commands **
 ##
@@ -0,0 +1,134 @@
+"""
+============================
+===  benchmark_ingest.py ===
+============================
+usage: python benchmark_ingest.py [YEAR] [--fixtures DIR] [--workers N] [--commit-every N] [--latency MS] [--fresh]
+
+Measures build_db.py ingest throughput without touching ESPN, nflweather or Nominatim. A local
+stand-in server replays recorded responses, and the season gets written to the database in .env
+(point NFL_DB_NAME at a scratch database!). Reports games/sec, requests/game, DB round trips/game
+and peak RSS.
+
+Recording fixtures: the stand-in serves straight out of build_db.py's response cache, so run
+`python build_db.py YEAR` once with the cache on (the default) and that season is recorded.
+Nominatim is answered with a fixed location, since the coordinates don't matter here.
+
+--latency: added to every response to mimic a real network (default 0)
+--fresh: TRUNCATE the game/player/team tables first (CASCADE, so the tables referencing them, like the teamgame
+    rollup, are emptied too), so the whole season gets written again
+"""
+import sys, os, json, time, argparse, threading, resource
+import psycopg2, psycopg2.extensions
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import build_db
+
+class fixture_handler(BaseHTTPRequestHandler):
+    """Answers GET /{original host}/{path}?{query} with the cached response for https://{original host}/{path}?{query}"""
+    protocol_version = "HTTP/1.1" # keep-alive, like the real services
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency > 0: time.sleep(server.latency)
+        host, _, rest = self.path.lstrip("/").partition("/")
+        if host == "nominatim.openstreetmap.org":
+            status, body, content_type = 200, json.dumps([{"lat": "39.05", "lon": "-94.48", "display_name": "stand-in"}]).encode(), "application/json"
+        else:
+            status, body, content_type = 404, b"not recorded", "text/plain"
+            for scheme in ("https", "http"):
+                path = build_db.cache_path(server.fixtures, f"{scheme}://{host}/{rest}")
+                if os.path.exists(path + ".json"):
+                    with open(path + ".json") as f:
+                        meta = json.load(f)
+                    with open(path + ".body", "rb") as f:
+                        body = f.read()
+                    status, content_type = meta["status"], meta["headers"].get("Content-Type", "application/octet-stream")
+                    break
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        pass # one line per request drowns out the progress bar
+
+def start_server(fixtures: str, latency: float) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), fixture_handler)
+    server.daemon_threads = True
+    server.fixtures = fixtures
+    server.latency = latency
+    server.requests = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class counting_cursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        self.connection.round_trips += 1
+        return super().execute(query, vars)
+    def executemany(self, query, vars_list):
+        self.connection.round_trips += len(vars_list)
+        return super().executemany(query, vars_list)
+
+class counting_connection(psycopg2.extensions.connection):
+    """A connection that counts every statement and commit sent to the server"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_trips = 0
+        self.cursor_factory = counting_cursor
+    def commit(self):
+        self.round_trips += 1
+        return super().commit()
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark build_db.py ingest against a local stand-in for the scraped services")
+    parser.add_argument("year", type=int, help="season to ingest (must be recorded in the fixtures)")
+    parser.add_argument("--fixtures", default=os.getenv("NFL_CACHE_DIR", ".nflscraper_cache"),
+                        help="build_db.py response cache to serve from")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--commit-every", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds added to every response")
+    parser.add_argument("--fresh", action="store_true", help="empty the game/player/team tables (and teamgame, playerteam, injury, which reference them) before running")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if not os.path.isdir(args.fixtures):
+        print(f"No fixtures at {args.fixtures}, run `python build_db.py {args.year}` first to record them.")
+        sys.exit(1)
+    if args.fresh:
+        conn = build_db.connect()
+        # CASCADE also empties the tables that reference these (teamgame, playerteam, injury), or postgres refuses
+        conn.cursor().execute("TRUNCATE gameplayer, game, player, team, ingest_checkpoint CASCADE")
+        conn.commit()
+        conn.close()
+
+    server = start_server(args.fixtures, args.latency / 1000)
+    prefix = f"http://127.0.0.1:{server.server_address[1]}"
+    ingest_args = build_db.parse_args([str(args.year), "--no-cache", "--no-rate-limit", "--url-prefix", prefix,
+                                       "--workers", str(args.workers), "--commit-every", str(args.commit_every)])
+    # grab the connection on its way out so we can read its counters
+    connections = []
+    def connection_factory(*a, **kw):
+        conn = counting_connection(*a, **kw)
+        connections.append(conn)
+        return conn
+
+    start = time.perf_counter()
+    summary = build_db.ingest_season(args.year, ingest_args, connect_kwargs={"connection_factory": connection_factory})
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    games = max(1, summary["games"])
+    round_trips = sum(conn.round_trips for conn in connections)
+    print()
+    print(f"Games ingested:     {summary['games']} ({len(summary['failed'])} failed) in {elapsed:.2f}s")
+    print(f"Games/sec:          {summary['games'] / elapsed:.2f}")
+    print(f"Requests/game:      {server.requests / games:.2f} ({server.requests} total)")
+    print(f"DB round trips/game: {round_trips / games:.2f} ({round_trips} total)")
+    # ru_maxrss is in kilobytes on linux
+    print(f"Peak RSS:           {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+if __name__ == "__main__":
+    main()
+    sys.exit()
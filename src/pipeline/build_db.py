@@ -3,17 +3,32 @@
 ===      build_db.py     ===
 ===     Ethan Leyden     ===
 ============================
-usage: python build_db.py [YEAR] [optional ignore_date]
+usage: python build_db.py [YEAR | START-END] [optional ignore_date] [--workers N] [--processes N] [--commit-every N] 
+                          [--sync] [--cache-dir DIR | --no-cache] [--offline] [--backfill-teamgame]
+YEAR: YYYY, or a range of seasons like 2015-2023 (each season runs in its own process)
 ignore_date: YYYY-MM-DD
+--workers: number of events to fetch concurrently (default 8, 1 fetches serially)
+--processes: number of seasons to collect at once (default: one per season, up to the cpu count)
+--sync: only collect completed games that aren't in the db yet
+--commit-every: number of games written per transaction (default 1)
+--cache-dir: where HTTP responses are cached (default $NFL_CACHE_DIR or .nflscraper_cache)
+--offline: replay purely from the response cache, never touching the network
+--backfill-teamgame: only rebuild the teamgame rollup for the given seasons, from games already in the db
 """
-import sys, json, requests, warnings, os, re, time
-import psycopg2, pprint
+import sys, json, requests, warnings, os, re, time, argparse, threading, hashlib, tempfile, html, random
+import psycopg2, psycopg2.extras, pprint
 from tqdm import tqdm
 from datetime import datetime
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from geopy.geocoders import Nominatim
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup as bs
-import pandas as pd
+
+def cache_path(cache_dir: str, url: str) -> str:
+    """Where a URL's response lives in the on-disk cache (without the .json/.body suffix)"""
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return os.path.join(cache_dir, key[:2], key)
 
 def safe_float_conversion(value):
     try:
@@ -22,6 +37,72 @@ def safe_float_conversion(value):
         #print(err)
         return 0.0
     
+class token_bucket():
+    """Thread safe token bucket: allows `rate` requests per second on average, in bursts of up to `burst`"""
+    def __init__(self, rate: float, burst: float = None):
+        self.__rate = rate
+        self.__capacity = burst if burst is not None else max(1.0, rate)
+        self.__tokens = self.__capacity
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__rate)
+        self.__updated = now
+    def acquire(self):
+        """Blocks until a request is allowed"""
+        while True:
+            with self.__lock:
+                self.__refill()
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                wait = (1 - self.__tokens) / self.__rate
+            time.sleep(wait)
+    def pause(self, seconds: float):
+        """Stops handing out tokens for (at least) the given number of seconds, e.g. after a 429"""
+        with self.__lock:
+            self.__refill()
+            self.__tokens = min(self.__tokens, -seconds * self.__rate)
+
+class descriptor_matcher():
+    """Maps weather descriptions to a precipitation severity using one compiled regex, built from a
+    {severity: [descriptor, ...]} dictionary like the one from nflscraper.load_descriptors"""
+    def __init__(self, descriptors: dict):
+        self.__severity = {}
+        for severity in descriptors:
+            for descriptor in descriptors[severity]:
+                self.__severity[descriptor.lower()] = max(int(severity), self.__severity.get(descriptor.lower(), 0))
+        # longest first so that a descriptor containing another one isn't cut short
+        alternatives = sorted(self.__severity, key=len, reverse=True)
+        self.__pattern = re.compile("|".join(re.escape(d) for d in alternatives)) if alternatives else None
+    def severity(self, text):
+        """Returns the worst severity matched anywhere in text (or any of a list of texts), None if nothing matches"""
+        if isinstance(text, (list, tuple)): text = " ".join(text)
+        if not isinstance(text, str) or self.__pattern is None: return None # None (or NaN, from pandas) in the db
+        # since descriptors_v2, the game table stores the severity itself
+        if text.strip().isdigit(): return int(text)
+        matches = self.__pattern.findall(text.lower())
+        return max(self.__severity[m] for m in matches) if matches else None
+
+def parse_weather_page(content: bytes) -> list[tuple]:
+    """Pulls the (quarter, description, temperature) forecasts out of a raw nflweather game page. Only
+    the part of the page between the Kickoff/Q2/Q3/Q4 markers gets looked at, instead of the whole document."""
+    markers = (b"Kickoff", b"Q2", b"Q3", b"Q4")
+    starts = [i for i in (content.find(m) for m in markers) if i >= 0]
+    if len(starts) == 0: return []
+    end = max(content.rfind(m) for m in markers)
+    # plenty of room after the last marker for its description and temperature
+    block = content[min(starts):end + 4096].decode("utf-8", "replace")
+    # same text that BeautifulSoup's get_text() would give us: no scripts/styles, no tags, entities decoded
+    block = re.sub(r"<(script|style)\b.*?</\1\s*>", "", block, flags=re.S | re.I)
+    block = html.unescape(re.sub(r"<[^>]*>", "", block))
+    block = re.sub(r"\s+", " ", block)
+    # temps are the first number after "Kickoff", "Q2", "Q3", "Q4"
+    # Quarter [Weather] [Temp] 
+    weather = re.findall(r"(Kickoff|Q2|Q3|Q4)\s([a-zA-Z|\s]*)([0-9]{1,3})", block)
+    return [(i[0], i[1].strip().lower(), int(i[2])) for i in weather] # clean the strings
+
 class nflscraper():
     __loc = Nominatim(user_agent="GetLoc") # Library for getting coordinates from a place name
     __division = { # dictionary to look up divisions and conferences based on ESPN team "parent"
@@ -47,22 +128,182 @@ class nflscraper():
         3: ["rain", "thunderstorms"],
         4: ["snow"]
     }
+    # gameplayer stats that get summed into the teamgame rollup (keep in sync with the teamgame DDL in nfl_create.sql)
+    __rollup_features = ["adjqbr", "passingyards", "rushingyards", "fumbles", "totaltackles", "sacks", "interceptions", "qbhits"]
     # Load environment variables from .env file
     load_dotenv()
     warnings.filterwarnings("ignore", category=FutureWarning)
-    def __init__(self, cursor=None):
+    __geocode_lock = threading.Lock() # Nominatim only allows one request at a time, even when fetching events concurrently
+    __rate_limits = { # sustained requests per second we allow ourselves against each host
+        "site.api.espn.com": 10,
+        "www.nflweather.com": 2,
+        "nominatim.openstreetmap.org": 1, # their usage policy is an absolute max of one per second
+    }
+    __default_rate_limit = 5
+    __max_retries = 5 # on 429s, 5xxs and connection errors
+    __cache_ttl = { # how long (seconds) a cached response is trusted for each endpoint, None never expires
+        "scoreboard": 60 * 60, # the current season's scoreboard changes every week
+        "season": None, # scoreboards for seasons that are over
+        "summary": None, # boxscores for finished games never change
+        "summary_live": 60 * 60, # scheduled and in progress games' summaries fill in as the game is played
+        "team": 7 * 24 * 60 * 60,
+        "weather": None, # what the weather was at a finished game
+        "weather_live": 60 * 60, # a forecast
+    }
+    def __init__(self, cursor=None, max_connections=10, cache_dir=None, offline=False, rate_scale=1.0, url_prefix=None):
+        # one keep-alive session and rate limit per host, shared by every worker thread
+        self.__sessions = {}
+        self.__buckets = {}
+        self.__session_lock = threading.Lock()
+        self.__max_connections = max_connections
+        # when several processes share the same hosts, each one gets a slice of the rate limits (None turns them off)
+        self.__rate_scale = rate_scale
+        # send every request to http(s)://{url_prefix}/{original host}/... instead, e.g. a local stand-in server
+        self.__url_prefix = None if url_prefix is None else url_prefix.rstrip("/")
+        if self.__url_prefix is not None:
+            prefix = urlsplit(self.__url_prefix)
+            self.__loc = Nominatim(user_agent="GetLoc", scheme=prefix.scheme, 
+                                   domain=f"{prefix.netloc}{prefix.path}/nominatim.openstreetmap.org")
+        # on-disk response cache, keyed by a hash of the URL. offline mode replays exclusively from it
+        self.__cache_dir = cache_dir
+        self.__offline = offline
+        if offline and cache_dir is None:
+            raise ValueError("Offline mode needs a cache directory to replay from.")
+        if cache_dir is not None: os.makedirs(cache_dir, exist_ok=True)
         # TODO: potentially move this to build_db class in generate_csv.py if it improves decoupling and cohesion
         # this is where we set up __descriptors
         if cursor is not None:
             # create the dictionary from the db, else use the default
             self.__descriptors = nflscraper.load_descriptors(cursor)
+            self.__venues = nflscraper.load_venues(cursor)
         else:
             # just in case someone is running an old version of the db. 
             self.__descriptors = self.__descriptors_v2
+            self.__venues = {}
+        self.__matcher = descriptor_matcher(self.__descriptors)
 
         return
+    def __session(self, url: str) -> requests.Session:
+        host = urlsplit(url).netloc
+        with self.__session_lock:
+            if host not in self.__sessions:
+                session = requests.Session()
+                # size the connection pool to the number of workers so connections get reused instead of discarded
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.__max_connections)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.__sessions[host] = session
+            return self.__sessions[host]
+    def __route(self, url: str) -> str:
+        if self.__url_prefix is None: return url
+        parts = urlsplit(url)
+        return f"{self.__url_prefix}/{parts.netloc}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+    def __throttle(self, host: str):
+        if self.__rate_scale is not None: self.__bucket(host).acquire()
+    def __bucket(self, host: str) -> token_bucket:
+        with self.__session_lock:
+            if host not in self.__buckets:
+                rate = nflscraper.__rate_limits.get(host, nflscraper.__default_rate_limit) * self.__rate_scale
+                self.__buckets[host] = token_bucket(rate)
+            return self.__buckets[host]
+    def __backoff(attempt: int) -> float:
+        # exponential backoff with "full jitter", so retrying workers don't all come back at the same moment
+        return random.uniform(0, min(60, 2 ** attempt))
+    def __request(self, url: str, headers: dict) -> requests.Response:
+        """GET a URL, staying under the host's rate limit and retrying 429s, 5xxs and connection errors.
+        Gives back the last response (or raises the last connection error) once we run out of retries."""
+        host, target = urlsplit(url).netloc, self.__route(url)
+        for attempt in range(nflscraper.__max_retries + 1):
+            self.__throttle(host)
+            try:
+                response = self.__session(target).get(target, headers=headers, timeout=30)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == nflscraper.__max_retries: raise
+                time.sleep(nflscraper.__backoff(attempt))
+                continue
+            if response.status_code != 429 and response.status_code < 500: return response
+            if attempt == nflscraper.__max_retries: return response
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else nflscraper.__backoff(attempt)
+            if response.status_code == 429 and self.__rate_scale is not None:
+                self.__bucket(host).pause(delay) # we're over the limit, so every worker on this host waits, not just this one
+            time.sleep(delay)
+    def __geocode(self, query: str):
+        self.__throttle("nominatim.openstreetmap.org")
+        return self.__loc.geocode(query)
+    def __cache_path(self, url: str) -> str:
+        return cache_path(self.__cache_dir, url)
+    def __cache_read(self, url: str):
+        """Returns the cached response for a URL, when it was fetched and the endpoint it was cached as, or
+        (None, None, None) if it isn't cached"""
+        if self.__cache_dir is None: return None, None, None
+        path = self.__cache_path(url)
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+            with open(path + ".body", "rb") as f:
+                body = f.read()
+        except FileNotFoundError:
+            return None, None, None
+        response = requests.Response()
+        response.url = url
+        response.status_code = meta["status"]
+        response.headers.update(meta["headers"])
+        response.encoding = meta["encoding"]
+        response._content = body
+        return response, meta["fetched"], meta.get("endpoint")
+    def __cache_write(self, url: str, response: requests.Response, endpoint: str):
+        path = self.__cache_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {
+            "url": url,
+            "status": response.status_code,
+            "fetched": time.time(),
+            "endpoint": endpoint,
+            "encoding": response.encoding,
+            "headers": {key: response.headers[key] for key in ("Content-Type", "ETag", "Last-Modified") if key in response.headers},
+        }
+        # write to a temp file then rename, so another thread never sees a half written entry
+        for suffix, content in ((".body", response.content), (".json", json.dumps(meta).encode())):
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp, path + suffix)
+    def __get(self, url: str, endpoint: str) -> requests.Response:
+        cached, fetched, cached_endpoint = self.__cache_read(url)
+        ttl = nflscraper.__cache_ttl[endpoint]
+        # something cached as another endpoint, e.g. the summary of a game that was still in progress, is out of date now
+        fresh = cached_endpoint == endpoint and (ttl is None or time.time() - fetched <= ttl)
+        # when offline, a stale response is better than none at all
+        if cached is not None and (self.__offline or fresh):
+            return cached
+        if self.__offline:
+            raise requests.exceptions.ConnectionError(f"Offline mode: no cached response for {url}")
+        # if we have an expired copy, ask the server whether it changed. a 304 has no body to download
+        headers = {}
+        if cached is not None:
+            if "ETag" in cached.headers: headers["If-None-Match"] = cached.headers["ETag"]
+            if "Last-Modified" in cached.headers: headers["If-Modified-Since"] = cached.headers["Last-Modified"]
+        response = self.__request(url, headers)
+        if response.status_code == 304 and cached is not None:
+            self.__cache_write(url, cached, endpoint) # still good, restart its ttl
+            return cached
+        # only successful responses are cached, so errors get retried next run
+        if self.__cache_dir is not None and response.status_code == 200:
+            self.__cache_write(url, response, endpoint)
+        return response
+    def __get_json(self, url: str, endpoint: str):
+        response = self.__get(url, endpoint)
+        response.raise_for_status()
+        return response.json()
+    def __season_finished(year: int) -> bool:
+        # the season ends with the super bowl in february of the following year
+        now = datetime.now()
+        return year < now.year - 1 or (year == now.year - 1 and now.month > 2)
     def get_descriptors_v2():
         return nflscraper.__descriptors_v2
+    def get_rollup_features():
+        return nflscraper.__rollup_features
     def load_descriptors(cursor) -> dict:
         # create the dictionary from the db, else use the default
         cursor.execute("select * from precipitation");
@@ -73,7 +314,43 @@ class nflscraper():
                 descriptors[i[2]] = []
             descriptors[i[2]].append(i[1])
         return descriptors
-    def get_weather_by_game(self, home, away, season, week):
+    def load_venues(cursor) -> dict:
+        """Returns the geocoded venues already in the db as a dictionary of name: (lat, lon)"""
+        try:
+            cursor.execute("select name, lat, lon from venue")
+        except psycopg2.errors.UndefinedTable:
+            # older db without the venue table, every venue will be geocoded like before
+            print("No venue table found, create it with the venue DDL in nfl_create.sql to skip repeat geocoding.")
+            cursor.connection.rollback()
+            return {}
+        return {name: (lat, lon) for name, lat, lon in cursor.fetchall()}
+    def venue_name(espn_event: dict) -> str:
+        """The string we geocode for an event's venue"""
+        venue = espn_event["competitions"][0]["venue"]
+        state = venue["address"].get("state", None)
+        return f"{venue['fullName']} {venue['address']['city']} {'' if state is None else state}"
+    def prefetch_venues(self, events: list[dict], cursor=None) -> int:
+        """Geocodes every venue in a list of events that we haven't seen before, so the event loop never has
+        to wait on Nominatim. New venues are written to the venue table if a cursor is given (caller commits).
+        Returns the number of venues that were geocoded."""
+        new_venues = {}
+        for event in events:
+            try:
+                name = nflscraper.venue_name(event)
+            except KeyError: # extract_game_attributes will complain about this event later
+                continue
+            if name in self.__venues or name in new_venues: continue
+            venue = event["competitions"][0]["venue"]
+            new_venues[name] = (venue["fullName"], venue["address"]["city"], venue["address"].get("state", None))
+        for name in tqdm(new_venues, desc="Geocoding venues...", ncols=100, disable=len(new_venues) == 0):
+            lat, lon = self.getLocationCoords(name)
+            if lat is None: continue # don't remember failures, we'll try again next time
+            if cursor is not None:
+                stadium, city, state = new_venues[name]
+                cursor.execute("INSERT INTO venue (name, stadium, city, state, lat, lon) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
+                               (name, stadium, city, state, lat, lon))
+        return len(new_venues)
+    def get_weather_by_game(self, home, away, season, week, completed=True):
         # handle pre/postseason games. an unusual week number will indicate what "special week" it is
         if week >= 18 and season <= 2020: week += 1
         # handle commanders name changes
@@ -114,52 +391,24 @@ class nflscraper():
         # clean home/away strings so they match team names
         home, away = home.split()[-1], away.split()[-1]
         url = f"https://www.nflweather.com/games/{season}/{week}/{away}-at-{home}"
-        response = requests.get(url)
-        if response.status_code >= 400: # if there was an issue getting the weather data, we'll terminate.
+        response = self.__get(url, "weather" if completed else "weather_live")
+        if response.status_code >= 400: # if there was an issue getting the weather data, the game gets retried later
             print(f"HTTP Error: {response.status_code}")
             print(away, home, season, week, "|", url)
-            print(response.content)
-            sys.exit(1)
-
-        # turn the HTML blob into single-space separated textual content
-        response = re.sub(r"\s+", " ", bs(str(response.content), 'html.parser').get_text().replace("\\n", ""))
-        # temps are the first number after "Kickoff", "Q2", "Q3", "Q4"
-        # Quarter [Weather] [Temp] 
-        weather = re.findall(r"(Kickoff|Q2|Q3|Q4)\s([a-zA-Z|\s]*)([0-9]{1,3})", response)
+            response.raise_for_status()
+
+        weather = parse_weather_page(response.content)
         if len(weather) == 0: # didn't grab any weather data
             print("Unable to parse nflweather page for this game:")
             print(away, home, season, week, "|", url)
-            print(response)
             return {}
             
-        weather = [(i[0], i[1].strip().lower(), int(i[2])) for i in weather] # clean the strings
         temp = sum([i[2] for i in weather]) / len(weather) # average temperature
-        # "worst" weather descriptor
-        descriptor = None
-
-        # ==== BEGIN REPLACE
-        # TODO: Question complexity of the following four lines?
         # match to the descriptor with the worst severity
-        for severity_level in self.__descriptors_v2: # for each of the severity levels
-            for predefined_desc in self.__descriptors_v2[severity_level]: # for each of the descriptors in that severity level
-                for scraped_desc in weather:
-                    if predefined_desc in scraped_desc[1]: 
-                        descriptor = severity_level
+        descriptor = self.__matcher.severity([i[1] for i in weather])
         # match to the one of the last quarter
         if descriptor is None: 
-            descriptor = weather[-1:]
-        # ==== END REPLACE
-
-        # ==== BEGIN REMOVE (commented out until I can verify that the new method works, delete upon verification)
-        # for d in self.__descriptors: # for each of the possible descriptors
-        #     for w in weather: # for weather in each of the 4 quarters
-        #         if d in w[1]: descriptor = d # if its later in the list, it is more severe
-        # if descriptor is None:
-        #     for d in self.__descriptors:
-        #         for w in weather:
-        #             print(f"{d} | {w} | {d in w}")
-        #     print(f"Could not match descriptor for {[w[1] for w in weather]}")
-        # ==== END REMOVE
+            descriptor = weather[-1][1][:20]
 
         # TODO: grab windspeed
         return {"temperature": temp, "precipitation": descriptor}
@@ -213,15 +462,21 @@ class nflscraper():
                 print(f"Error: Unable to fetch data. Status code {response.status_code}")
             return None
     def getLocationCoords(self, stadium_name: str):
+        # check the venue table before asking Nominatim
+        if stadium_name in self.__venues: return self.__venues[stadium_name]
+        # geocoding isn't cached, and the coordinates aren't written to the game table anyway
+        if self.__offline: return None, None
+        venue = stadium_name
         attempts = 0
         while attempts < 3:
             if attempts > 0: print("Querying coords...", end="")
             try:
-                location = nflscraper.__loc.geocode(stadium_name)
-                # if there is an issue, then it likely has to do with the stadium name, so we'll keep City + state
-                while location is None and len(stadium_name) > 0:
-                    stadium_name = ' '.join(stadium_name.split()[1:])
-                    location = nflscraper.__loc.geocode(stadium_name)
+                with nflscraper.__geocode_lock:
+                    location = self.__geocode(stadium_name)
+                    # if there is an issue, then it likely has to do with the stadium name, so we'll keep City + state
+                    while location is None and len(stadium_name) > 0:
+                        stadium_name = ' '.join(stadium_name.split()[1:])
+                        location = self.__geocode(stadium_name)
                 if len(stadium_name) <= 0:
                     print("Couldn't find lat/lon")
                     sys.exit()
@@ -229,18 +484,20 @@ class nflscraper():
                 attempts = 99
             except Exception as err:
                 print(str(err))
-                time.sleep(1)
+                time.sleep(nflscraper.__backoff(attempts))
                 attempts += 1
                 if attempts == 3: return None, None
+        self.__venues[venue] = (location.latitude, location.longitude)
         return location.latitude, location.longitude
     def events_list(self, year: int) -> dict:
-        return requests.get(self.__event_api_string(year)).json()["events"]
-    def interpret_boxscore(self, event, game) -> dict:
+        endpoint = "season" if nflscraper.__season_finished(year) else "scoreboard"
+        return self.__get_json(self.__event_api_string(year), endpoint)["events"]
+    def interpret_boxscore(self, event, game, completed=True) -> dict:
         """
         Returns a list of players, with their corresponding statistics based on the boxscore object for that game, as well as a dictionary containing athlete_id: name pairs to
         streamline the population of the players table
         """
-        api_boxscore = requests.get(self.__boxscore_api_string(event)).json()["boxscore"]
+        api_boxscore = self.__get_json(self.__boxscore_api_string(event), "summary" if completed else "summary_live")["boxscore"]
         players = {}
         boxscore = {}
         # TODO: CAPTURE PLAYER DATA like name, team history, etc.
@@ -275,7 +532,7 @@ class nflscraper():
         return boxscore, players
     def get_team(self, id) -> list[dict]:
         team = {}
-        data = requests.get(self.__team_api_string(id)).json()["team"]
+        data = self.__get_json(self.__team_api_string(id), "team")["team"]
         team["id"] = int(data["id"])
         team["name"] = data["name"]
         team["display_name"] = data["displayName"]
@@ -323,8 +580,7 @@ class nflscraper():
         elif(int(espn_event["season"]["type"]) == 1):
             game["week"] -= 5 # on the nflweather, hall-of-game-weekend is grouped with preseason week 1
         # compute the latitude and longitude of the game to obtain weather data
-        locationName = f"{game['stadium']} {game['city']} {'' if game['state'] is None else game['state']}"
-        game["lat"], game["lon"] = self.getLocationCoords(locationName)
+        game["lat"], game["lon"] = self.getLocationCoords(nflscraper.venue_name(espn_event))
         return game
     def rowify_player(self, game_id: int, player_id: int, player: dict) -> dict:
         row = {
@@ -377,45 +633,158 @@ class nflscraper():
 
 
 
-def generateInsertStatement(table, obj):
-    keys = ', '.join(obj.keys())
-    values = ', '.join([f"\'{str(value).replace('\'', '\'\'')}\'" if isinstance(value, str) else str(value) for value in obj.values()])
-    return f"""INSERT INTO {table} ({keys}) VALUES ({values});"""
+def insert_rows(cursor, table: str, rows: list[dict], page_size: int = 1000):
+    """Writes a batch of rows to a table with a single parameterized INSERT (per page_size rows).
+    The rows don't need to share keys -- any column a row is missing is written as NULL. Rows that
+    would violate a key constraint are skipped, so re-running a season is harmless."""
+    if len(rows) == 0: return
+    columns = list(dict.fromkeys(key for row in rows for key in row)) # union of keys, in first seen order
+    values = [tuple(row.get(column) for column in columns) for row in rows]
+    psycopg2.extras.execute_values(cursor, 
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s ON CONFLICT DO NOTHING", 
+        values, page_size=page_size)
 
-def main():
-    missing_weather = []
-    num_games = 0
-    if len(sys.argv) > 1:
-        year = int(sys.argv[1])
-        # ignore all events with an ID less than the given optional argument
-        ignore_prior_to = datetime.strptime(sys.argv[2], "%Y-%m-%d").date() if len(sys.argv) > 2 else None
+def has_table(cursor, table: str) -> bool:
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+    return cursor.fetchone()[0]
+
+def rollup_teamgames(cursor, game_ids: list[int] = None, seasons: list[int] = None):
+    """(Re)writes the teamgame rows (one per team per game, boxscores summed per team) for the given games,
+    or every game in the given seasons, from what's already in the game and gameplayer tables."""
+    features = nflscraper.get_rollup_features()
+    if game_ids is not None:
+        games, params = "%(ids)s", {"ids": list(game_ids)}
     else:
-        print("Usage: python build_db.py [YEAR] [optional -- eventID]\nAn eventID argument will tell the scraper to ignore all events with an ID less than the one given")
-        sys.exit()
-    # set up database
-    load_dotenv()
+        games, params = "ARRAY(SELECT id FROM game WHERE season = ANY(%(seasons)s))", {"seasons": list(seasons)}
+    columns = ["game", "team", "is_home", "gameday", "season", "score", "third_dwn_pct", *features]
+    cursor.execute(f"""
+    INSERT INTO teamgame ({', '.join(columns)})
+    SELECT g.id, side.team, side.is_home, g.gameday, g.season, side.score, side.third_dwn_pct{''.join([f', tb.{f}' for f in features])}
+    FROM game g
+    CROSS JOIN LATERAL (VALUES (g.home_team_id, true, g.home_score, g.home_third_dwn_pct),
+                               (g.away_team_id, false, g.away_score, g.away_third_dwn_pct)) AS side(team, is_home, score, third_dwn_pct)
+    LEFT JOIN (
+        SELECT game, team{''.join([f', SUM({f}) AS {f}' for f in features])}
+        FROM gameplayer WHERE game = ANY({games}) GROUP BY game, team
+    ) tb ON tb.game = g.id AND tb.team = side.team
+    WHERE g.id = ANY({games})
+    ON CONFLICT (game, team) DO UPDATE SET ({', '.join(columns[2:])}) = ({', '.join([f'EXCLUDED.{c}' for c in columns[2:]])})
+    """, params)
+    return cursor.rowcount
+
+def fetch_event(ns: nflscraper, event: dict):
+    """Does all of the network work for a single event (geocode, weather, boxscore). This runs in a
+    worker thread, so it must not touch the database -- writes happen back on the main thread."""
+    game = ns.extract_game_attributes(event)
+    # a game that isn't over yet only gets its summary/forecast cached for a little while
+    completed = is_completed(event)
+    weather = ns.get_weather_by_game(game["home_team_name"], game["away_team_name"], game["season"], game["week"], completed)
+    boxscore, players = ns.interpret_boxscore(game["id"], game, completed)
+    return game, weather, boxscore, players
 
-    conn = psycopg2.connect(
+def is_pro_bowl(event: dict) -> bool:
+    # check if the game is the pro bowl -- no impact on super bowl
+    return (event["shortName"] == "AFC VS NFC" or 
+            event["shortName"] == "NFC VS AFC" or 
+            "IRV" in event["shortName"] or # rice and irvine are popular team names to choose for the pro bowl
+            "RIC" in event["shortName"])
+
+def season_range(value: str) -> list[int]:
+    """Parses a season argument: a single year (2023) or an inclusive range (2015-2023)"""
+    try:
+        first, _, last = value.partition("-")
+        first, last = int(first), int(last) if last else int(first)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected YYYY or YYYY-YYYY, got {value}")
+    if last < first: raise argparse.ArgumentTypeError(f"{value} ends before it starts")
+    return list(range(first, last + 1))
+
+def is_completed(event: dict) -> bool:
+    # scheduled and in progress games don't have a final boxscore yet
+    return event.get("status", {}).get("type", {}).get("completed", False)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Collect NFL game data for one or more seasons and write it to the DB")
+    parser.add_argument("seasons", type=season_range, help="season to collect (YYYY), or a range of seasons (YYYY-YYYY)")
+    parser.add_argument("ignore_date", nargs="?", default=None, 
+                        type=lambda d: datetime.strptime(d, "%Y-%m-%d").date(),
+                        help="ignore all events on or before this date (YYYY-MM-DD)")
+    parser.add_argument("--workers", type=int, default=8, 
+                        help="number of events to fetch concurrently (1 = serial)")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="number of seasons to collect in parallel (default: one per season, up to the cpu count)")
+    parser.add_argument("--commit-every", type=int, default=1,
+                        help="number of games to write per transaction")
+    parser.add_argument("--sync", action="store_true",
+                        help="only collect games that are over and not in the db yet (for weekly in-season updates)")
+    parser.add_argument("--cache-dir", default=os.getenv("NFL_CACHE_DIR", ".nflscraper_cache"),
+                        help="directory for the on-disk HTTP response cache")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the response cache")
+    parser.add_argument("--offline", action="store_true", 
+                        help="replay responses from the cache only, without making any requests")
+    # mostly for benchmark_ingest.py, which points the scraper at a local stand-in for ESPN/nflweather/Nominatim
+    parser.add_argument("--url-prefix", default=None, 
+                        help="send every request to {URL_PREFIX}/{original host}/... instead of the real services")
+    parser.add_argument("--no-rate-limit", action="store_true", help="don't rate limit requests (only for local servers!)")
+    parser.add_argument("--backfill-teamgame", action="store_true",
+                        help="don't scrape anything, just rebuild the teamgame rollup for games already in the db")
+    return parser.parse_args(argv)
+
+def connect(**kwargs):
+    load_dotenv()
+    return psycopg2.connect(
         database=os.getenv("NFL_DB_NAME"),
         host=os.getenv("NFL_DB_HOST"),
         user=os.getenv("NFL_DB_USER"),
         password=os.getenv("NFL_DB_PASS"),
-        port=os.getenv("NFL_DB_PORT"))
+        port=os.getenv("NFL_DB_PORT"),
+        **kwargs)
+
+def load_checkpoints(cursor, year: int):
+    """Returns the set of event ids already ingested for a season, or None if the db has no checkpoint table"""
+    try:
+        cursor.execute("select event_id from ingest_checkpoint where season = %s and status = 'done'", (year,))
+    except psycopg2.errors.UndefinedTable:
+        print("No ingest_checkpoint table found, create it with the DDL in nfl_create.sql to make runs resumable.")
+        cursor.connection.rollback()
+        return None
+    return {row[0] for row in cursor.fetchall()}
+
+def ingest_season(year: int, args, position: int = 0, rate_scale: float = 1.0, connect_kwargs: dict = None) -> dict:
+    """Collects every event in a season and writes it to the db. Each season gets its own connection,
+    so this can run in its own process. Events that were finished by a previous run are skipped.
+    connect_kwargs are passed on to psycopg2.connect (e.g. a connection_factory)."""
+    missing_weather = []
+    num_games = 0
+    # ignore all events before the given optional date
+    ignore_prior_to = args.ignore_date
+    workers = max(1, args.workers)
+    commit_every = max(1, args.commit_every)
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    # set up database
+    conn = connect(**(connect_kwargs or {}))
     cursor = conn.cursor()
 
     # get all entities already existing 
     cursor.execute("select id from team")
-    team_ids = [team[0] for team in cursor.fetchall()]
+    # (sets, and kept up to date as we write, so checking them doesn't get slower as the db grows)
+    team_ids = {team[0] for team in cursor.fetchall()}
     cursor.execute("select id from player")
-    player_ids = [player[0] for player in cursor.fetchall()]
+    player_ids = {player[0] for player in cursor.fetchall()}
     cursor.execute("select id from game")
-    game_ids = [game[0] for game in cursor.fetchall()]
-    ns = nflscraper(cursor=cursor)
+    game_ids = {game[0] for game in cursor.fetchall()}
+    finished_events = load_checkpoints(cursor, year)
+    rollup = has_table(cursor, "teamgame")
+    if not rollup: print("No teamgame table found, create it with the DDL in nfl_create.sql (then run --backfill-teamgame) to keep the rollup up to date.")
+    ns = nflscraper(cursor=cursor, max_connections=workers, cache_dir=cache_dir, offline=args.offline, 
+                    rate_scale=None if args.no_rate_limit else rate_scale, url_prefix=args.url_prefix)
     print(f"Getting NFL data for {year}")
     events = ns.events_list(year)
+
+    # figure out which events we actually need before handing them to the workers
+    todo = []
     haveSkipped = False
-    progress_bar = tqdm(total = len(events), desc="Processing events...", ncols = 100)
-    statusline = tqdm(total = 0, position=1, bar_format='{desc}')
     for idx, event in enumerate(events):
         # see if event is before specified date
         if ignore_prior_to is not None and datetime.strptime(event["date"], "%Y-%m-%dT%H:%MZ").date() <= ignore_prior_to:
@@ -424,85 +793,158 @@ def main():
                 haveSkipped = True
             print(event["id"], end=", ")
             continue
-        elif haveSkipped: 
-            haveSkipped = False
-            print()
+        if is_pro_bowl(event): continue
+        # already written by a previous (possibly interrupted) run
+        if finished_events is not None and int(event["id"]) in finished_events: continue
+        # sync mode only picks up games that are over and that we don't have yet
+        if args.sync and (int(event["id"]) in game_ids or not is_completed(event)): continue
+        todo.append((idx, event))
+    if haveSkipped: print()
+    if args.sync: print(f"{year}: {len(todo)} new completed games to sync")
+    elif finished_events: print(f"{year}: resuming, {len(todo)} events left")
+    # geocode every stadium up front (~35 a season) instead of once per game in the workers
+    ns.prefetch_venues([event for _, event in todo], cursor)
+    conn.commit()
 
-        # check if the game is the pro bowl -- no impact on super bowl
-        if (event["shortName"] == "AFC VS NFC" or 
-            event["shortName"] == "NFC VS AFC" or 
-            "IRV" in event["shortName"] or # rice and irvine are popular team names to choose for the pro bowl
-            "RIC" in event["shortName"]): 
-                continue
+    pending_games = 0 # games written since the last commit
+    progress_bar = tqdm(total = len(todo), desc=f"Processing {year} events...", ncols = 100, position=position)
+    statusline = tqdm(total = 0, position=position + 1, bar_format='{desc}')
 
-        # gather the data from the api
-        try:
-            game = ns.extract_game_attributes(event)
-        except KeyError as err:
-            print(err)
-            print(event)
-            sys.exit(1)
+    def write_event(idx, completed, game, weather, boxscore, players):
+        nonlocal pending_games, num_games
+        # check if the teams are in the DB, if not, we'll need to add them. 
+        # (fetched before writing anything, so a failed request doesn't leave half a game in the transaction)
+        new_teams = [ns.get_team(team_id) for team_id in sorted({game["home_team_id"], game["away_team_id"]}) if team_id not in team_ids]
 
-        weather = ns.get_weather_by_game(game["home_team_name"], game["away_team_name"], game["season"], game["week"])
         if not weather:
             missing_weather.append(game["id"])
-        boxscore, players = ns.interpret_boxscore(game["id"], game)
         
         # Add any new players to the players table
-        new_athletes = 0
-        for athlete in players.keys():
-            if athlete not in player_ids:
-                new_athletes += 1
-                cursor.execute(generateInsertStatement("player", {"id": athlete, "name": players[athlete]}))
-                player_ids.append(athlete)
-        if new_athletes > 0: conn.commit()
-
-        # check if the team is in the DB, if not, we'll need to add it. 
-        if(game["home_team_id"] not in team_ids):
-            cursor.execute(generateInsertStatement("team", ns.get_team(game["home_team_id"])))
-            conn.commit()
-            team_ids.append(game["home_team_id"])
-        if(game["away_team_id"] not in team_ids):
-            cursor.execute(generateInsertStatement("team", ns.get_team(game["away_team_id"])))
-            conn.commit()
-            team_ids.append(game["away_team_id"])
+        # (sorted, so concurrent seasons always lock rows in the same order and can't deadlock)
+        new_players = [{"id": athlete, "name": players[athlete]} for athlete in sorted(players) if athlete not in player_ids]
+        insert_rows(cursor, "player", new_players)
+        player_ids.update([player["id"] for player in new_players])
+
+        insert_rows(cursor, "team", new_teams)
+        team_ids.update([team["id"] for team in new_teams])
 
         # insert the game into the db
         game_stats = ns.rowify_game(game, weather)
         if(game["id"] not in game_ids):
             try:
-                cursor.execute(generateInsertStatement("game", game_stats))
-            except psycopg2.errors.UndefinedColumn as err:
-                print(generateInsertStatement("game", game_stats))
+                insert_rows(cursor, "game", [game_stats])
+            except (psycopg2.errors.UndefinedColumn, psycopg2.errors.SyntaxError) as err:
+                print(game_stats)
                 print(err)
                 sys.exit(1)
-            except psycopg2.errors.SyntaxError as err:
-                print(generateInsertStatement("game", game_stats))
-                print(err)
-                sys.exit(1)
-            conn.commit()
-            game_ids.append(game["id"])
+            game_ids.add(game["id"])
         
         # insert the boxscore for all players who played in that game
-        player_game_stats = []
-        cursor.execute("select game, player from gameplayer")
-        gameplayer_ids = cursor.fetchall()
-        for player in boxscore:
-            # all players should be added on line 251 --> What did I mean by this?
-
-            # convert the boxscore for this player at this game into a writeable row, and write it
-            player_game = ns.rowify_player(game["id"], player, boxscore[player])
-            if (player_game["game"], player_game["player"]) not in gameplayer_ids:
-                cursor.execute(generateInsertStatement("gameplayer", player_game))
-                player_game_stats.append(player_game)
-        conn.commit()
-        if game["home_team_id"] not in team_ids: team_ids.append(game["home_team_id"])
-        if game["away_team_id"] not in team_ids: team_ids.append(game["away_team_id"])
+        # rows we already have (e.g. a game from a previous run) are dropped by the (game, player) primary key
+        player_game_stats = [ns.rowify_player(game["id"], player, boxscore[player]) for player in boxscore]
+        insert_rows(cursor, "gameplayer", player_game_stats)
+        if rollup:
+            rollup_teamgames(cursor, [game["id"]])
+        # the checkpoint is written in the same transaction as the game, so it can't claim a game we don't have.
+        # a scheduled or in progress game goes in without its final score/boxscores, so it isn't done yet (the next run fetches it again)
+        if finished_events is not None and completed:
+            cursor.execute("""INSERT INTO ingest_checkpoint (event_id, season, status) VALUES (%s, %s, 'done')
+                ON CONFLICT (event_id) DO UPDATE SET status = EXCLUDED.status, updated = now()""", (game["id"], year))
+        # the whole game (players, teams, game, boxscores) goes in one transaction
+        pending_games += 1
+        if pending_games >= commit_every:
+            conn.commit()
+            pending_games = 0
         num_games += 1
         progress_bar.update(1)
         statusline.set_description_str(f"{idx} | Game {game['id']} (Week {game['week']} | {game['away_team_name']} at {game['home_team_name']}) on [{game['gameday']}]: {len(player_game_stats)} boxscores.")
+
+    deferred = [] # events whose requests failed even after retrying, we'll give them another go at the end
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # fetches run concurrently, but we consume the results in event order so the DB writes
+        # happen in the same order (and on the same connection) as a serial run
+        futures = [(idx, event, executor.submit(fetch_event, ns, event)) for idx, event in todo]
+        for idx, event, future in futures:
+            # gather the data from the api
+            try:
+                write_event(idx, is_completed(event), *future.result())
+            except requests.exceptions.RequestException as err:
+                statusline.set_description_str(f"{idx} | Game {event['id']}: {err!r}, retrying at the end")
+                deferred.append((idx, event))
+            except KeyError as err:
+                print(err)
+                print(event)
+                executor.shutdown(wait=False, cancel_futures=True)
+                conn.commit() # keep the games we've finished so the next run can resume from here
+                sys.exit(1)
+
+    # by now whatever was throttling us has (hopefully) cooled off
+    failed_events = []
+    for idx, event in deferred:
+        try:
+            write_event(idx, is_completed(event), *fetch_event(ns, event))
+        except requests.exceptions.RequestException as err:
+            print(f"Giving up on event {event['id']} for now: {err!r}")
+            failed_events.append(int(event["id"]))
+    conn.commit()
     conn.close()
-    print(f"Collected data for {num_games} games, missing weather data for: {missing_weather}")
+    return {"season": year, "games": num_games, "missing_weather": missing_weather, "failed": failed_events}
+
+def backfill_teamgame(seasons: list[int]):
+    conn = connect()
+    cursor = conn.cursor()
+    if not has_table(cursor, "teamgame"):
+        print("No teamgame table found, create it with the DDL in nfl_create.sql first.")
+        sys.exit(1)
+    for year in tqdm(seasons, desc="Rolling up boxscores...", ncols=100):
+        rows = rollup_teamgames(cursor, seasons=[year])
+        conn.commit()
+        tqdm.write(f"{year}: {rows} teamgame rows")
+    conn.close()
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.backfill_teamgame:
+        backfill_teamgame(args.seasons)
+        return
+    if args.offline and args.no_cache:
+        print("--offline replays from the cache, so it can't be combined with --no-cache")
+        sys.exit(1)
+    seasons = args.seasons
+    failed = []
+    if len(seasons) == 1:
+        summaries = [ingest_season(seasons[0], args)]
+    else:
+        # geocode all of the venues once, here, so the season processes don't all hit Nominatim at the same time
+        conn = connect()
+        ns = nflscraper(cursor=conn.cursor(), cache_dir=None if args.no_cache else args.cache_dir, offline=args.offline,
+                        rate_scale=None if args.no_rate_limit else 1.0, url_prefix=args.url_prefix)
+        for year in seasons:
+            ns.prefetch_venues(ns.events_list(year), conn.cursor())
+        conn.commit()
+        conn.close()
+
+        summaries = []
+        processes = args.processes or min(len(seasons), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            # the processes share the same hosts, so they split the rate limits between them
+            futures = {pool.submit(ingest_season, year, args, 2 * i, 1 / processes): year for i, year in enumerate(seasons)}
+            for future in as_completed(futures):
+                try:
+                    summaries.append(future.result())
+                except (Exception, SystemExit) as err:
+                    # the other seasons keep going, and a rerun picks this one up where it stopped
+                    print(f"{futures[future]} failed: {err!r}")
+                    failed.append(futures[future])
+        summaries.sort(key=lambda summary: summary["season"])
+    for summary in summaries:
+        print(f"{summary['season']}: Collected data for {summary['games']} games, missing weather data for: {summary['missing_weather']}")
+        if len(summary["failed"]) > 0:
+            print(f"{summary['season']}: Couldn't fetch events {summary['failed']}, rerun to try them again.")
+            failed.append(summary["season"])
+    if len(failed) > 0:
+        print(f"Seasons {sorted(failed)} did not finish. Rerun the same command to resume them.")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
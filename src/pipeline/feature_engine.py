@@ -0,0 +1,130 @@
+"""
+============================
+===   feature_engine.py  ===
+============================
+Computes the same features as nfldb.aggregate_team_data, but for every game at once. Instead of two
+queries per game, the game table and the per-team boxscore totals are loaded once, laid out as one
+chronological timeline per team, and the prior-N aggregations are running aggregates walked along it once (recursive_aggregator).
+"""
+import numpy as np
+import pandas as pd
+
+class recursive_aggregator():
+    """Running aggregate over the previous games of a batch of teams, updated in constant time per game no matter
+    how long the window is. Holds one row of state per team: a discounted sum (S = x + d * S), and a sum and
+    count of the values that aren't missing (for averages). With a window (n_prev_games), the last n values are
+    kept in a ring buffer so the one falling out of the window can be subtracted back out; without one
+    (n_prev_games=None) it's the whole history."""
+    def __init__(self, shape: tuple, n_prev_games: int = None, agg_method: str = "avg", discount_factor: float = 0.9):
+        self.__window = n_prev_games
+        self.__agg_method = agg_method
+        self.__discount_factor = discount_factor
+        self.__discounted = np.zeros(shape)
+        self.__sum = np.zeros(shape)
+        self.__count = np.zeros(shape)
+        self.__buffer = None if n_prev_games is None else np.full((n_prev_games, *shape), np.nan)
+        self.__head = 0 # the oldest value in the buffer, and where the next one goes
+    def value(self) -> np.ndarray:
+        """The aggregate of everything pushed so far (NaN for an average with nothing to average)"""
+        if self.__agg_method == "discounted_sum": return self.__discounted.copy()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.__count > 0, self.__sum / self.__count, np.nan)
+    def push(self, values: np.ndarray):
+        """Adds the next game. Missing values count as 0 in the discounted sum and are skipped by the averages."""
+        present = ~np.isnan(values)
+        values = np.where(present, values, 0)
+        if self.__buffer is not None:
+            oldest = self.__buffer[self.__head]
+            oldest_present = ~np.isnan(oldest)
+            oldest = np.where(oldest_present, oldest, 0)
+            # it's about to be n + 1 games old, where it would have had weight discount_factor ** n
+            self.__discounted -= oldest * self.__discount_factor ** (self.__window - 1)
+            self.__sum -= oldest
+            self.__count -= oldest_present
+            self.__buffer[self.__head] = np.where(present, values, np.nan)
+            self.__head = (self.__head + 1) % self.__window
+        self.__discounted = values + self.__discount_factor * self.__discounted
+        self.__sum += values
+        self.__count += present
+
+class feature_engine():
+    __agg_methods = ["avg", "composite_avg", "discounted_sum"]
+    def __init__(self, games: pd.DataFrame, team_boxscores: pd.DataFrame, features: dict, weather_matcher):
+        """
+        Args:
+            games (pd.DataFrame): rows of the game table, including every season before the ones
+                we want features for (those are where the previous games come from)
+            team_boxscores (pd.DataFrame): gameplayer stats summed per team per game, with "game" and
+                "team" columns plus one column per player feature (see nfldb.load_team_boxscores)
+            features (dict): {"team": [...], "player": [...], "game": [...]} like nfldb's supported features
+            weather_matcher (descriptor_matcher): turns a game's precipitation into a severity
+        """
+        self.__games = games.sort_values(["gameday", "id"]).reset_index(drop=True)
+        self.__features = features
+        self.__matcher = weather_matcher
+        self.__timeline = self.__build_timeline(team_boxscores)
+        self.__prior_stats = {} # prior_stats results, so configs that share them (e.g. in a sweep) only compute them once
+    def __build_timeline(self, team_boxscores: pd.DataFrame) -> pd.DataFrame:
+        """One row per team per game, in chronological order within each team"""
+        sides = []
+        for side in ("home", "away"):
+            columns = {f"{side}_team_id": "team"} | {f"{side}_{feature}": feature for feature in self.__features["team"]}
+            sides.append(self.__games[["id", "gameday", *columns]].rename(columns={"id": "game"} | columns))
+        timeline = pd.concat(sides, ignore_index=True)
+        timeline = timeline.merge(team_boxscores[["game", "team", *self.__features["player"]]], on=["game", "team"], how="left")
+        return timeline.sort_values(["team", "gameday", "game"]).reset_index(drop=True)
+    def timeline(self) -> pd.DataFrame:
+        return self.__timeline
+    def prior_stats(self, n_prev_games: int = 5, agg_method: str = "avg", discount_factor: float = 0.9) -> pd.DataFrame:
+        """For every (game, team) in the timeline, aggregates the team's n previous games (all of them if
+        n_prev_games is None) for every team and player feature. Missing values (e.g. no boxscore for a stat)
+        are skipped by the averages and count as 0 in discounted sums, and a team without any previous games gets 0."""
+        if agg_method not in feature_engine.__agg_methods:
+            raise ValueError(f"Unknown agg_method {agg_method}, expected one of {feature_engine.__agg_methods}")
+        # composite_avg is the same average, and only discounted sums care about the discount
+        key = (n_prev_games, "discounted_sum" if agg_method == "discounted_sum" else "avg",
+               discount_factor if agg_method == "discounted_sum" else None)
+        if key not in self.__prior_stats:
+            self.__prior_stats[key] = self.__compute_prior_stats(n_prev_games, agg_method, discount_factor)
+        return self.__prior_stats[key]
+    def __compute_prior_stats(self, n_prev_games: int, agg_method: str, discount_factor: float) -> pd.DataFrame:
+        columns = self.__features["team"] + self.__features["player"]
+        teams, team_ids = pd.factorize(self.__timeline["team"])
+        position = self.__timeline.groupby("team").cumcount().to_numpy() # how many games the team has played before this one
+        # [team, nth game, feature], so all of the teams' nth games can be aggregated together
+        values = np.full((len(team_ids), position.max() + 1 if len(position) else 0, len(columns)), np.nan)
+        values[teams, position] = self.__timeline[columns].to_numpy(dtype=float)
+        stats = np.empty_like(values)
+        aggregator = recursive_aggregator((len(team_ids), len(columns)), n_prev_games, agg_method, discount_factor)
+        for nth in range(values.shape[1]):
+            stats[:, nth] = aggregator.value()
+            aggregator.push(values[:, nth])
+        stats = pd.DataFrame(stats[teams, position], columns=columns).fillna(0)
+        stats.index = pd.MultiIndex.from_frame(self.__timeline[["game", "team"]])
+        return stats
+    def generate(self, start_year: int, end_year: int, n_prev_games: int = 5, agg_method: str = "avg",
+                 discount_factor: float = 0.9, game_ids=None) -> pd.DataFrame:
+        """Builds the training rows (same columns as nfldb.aggregate_team_data) for every game from start_year to end_year,
+        or only the games in game_ids if it's given"""
+        stats = self.prior_stats(n_prev_games, agg_method, discount_factor)
+        games = self.__games[self.__games["season"].between(start_year, end_year)]
+        if game_ids is not None: games = games[games["id"].isin(game_ids)]
+        home = stats.reindex(pd.MultiIndex.from_arrays([games["id"], games["home_team_id"]]))
+        away = stats.reindex(pd.MultiIndex.from_arrays([games["id"], games["away_team_id"]]))
+
+        result = {}
+        for feature in self.__features["team"] + self.__features["player"]:
+            if agg_method == "composite_avg":
+                # negative number indicates favor of home team, positive number indicates favor of away team
+                result[feature] = away[feature].to_numpy() - home[feature].to_numpy()
+            else:
+                result[f"home_{feature}"] = home[feature].to_numpy()
+                result[f"away_{feature}"] = away[feature].to_numpy()
+        for feature in self.__features["game"]:
+            if feature == "precipitation":
+                result["precip_severity"] = [self.__matcher.severity(p) for p in games["precipitation"]]
+            if feature == "temperature":
+                result["temperature"] = games["temperature"].to_numpy()
+        result["game_id"] = games["id"].to_numpy()
+        result["label"] = np.where(games["home_score"] > games["away_score"], "Home", "Away")
+        return pd.DataFrame(result)
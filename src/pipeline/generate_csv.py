@@ -3,19 +3,42 @@
 ===    generate_csv.py   ===
 ===     Ethan Leyden     ===
 ============================
-usage: python generate_csv.py [START_YEAR] [END_YEAR]
+usage: python generate_csv.py [START_YEAR] [END_YEAR] [--engine vectorized|sql|query] 
+                               [--n-prev-games N|all ...] [--agg-method avg|composite_avg|discounted_sum ...] [--discount-factor D ...]
+                               [--pool-size N] [--append] [--processes N [--chunk-size N]]
+                               [--format csv|parquet|feather|npy] [--stream [--chunk-rows N] [--itersize N]]
 START_YEAR/END_YEAR: YYYY
 If no years are provided, the default range is 2015-2023
 If one year is provided, it is used as the start year (default end year is 2023)
+--engine: "vectorized" (default) loads everything once and computes all games together (see feature_engine.py),
+    "sql" has postgres compute everything in one window function query (good for large ranges on a remote db),
+    "query" runs two queries per game through aggregate_team_data
+--n-prev-games: how many of each team's previous games get aggregated (default 5), "all" uses every one of them. The
+    vectorized engine keeps a running aggregate per team (feature_engine.recursive_aggregator), so long windows cost nothing extra
+Passing several values to --n-prev-games/--agg-method/--discount-factor sweeps every combination of them, writing
+    nfl{START_YEAR}_{END_YEAR}_n{N}_{AGG_METHOD}[_d{D}].csv for each from a single read of the database
+--pool-size: max number of database connections nfldb keeps open (default 4)
+--append: add only the games that aren't in nfl{START_YEAR}_{END_YEAR}.csv yet (tracked in the .meta.json next to it),
+    the whole file is rebuilt if it was generated with different options
+--format: csv (default), parquet/feather (typed columns plus the options used in the file's metadata) or npy (a
+    directory of preprocessed float32 arrays the training scripts memory-map), see training_data.py
+--stream: with the sql or query engine, read rows through server-side cursors and write them out --chunk-rows at a
+    time, so memory stays flat however many seasons are exported
+--processes: split the games across N worker processes (by season, or --chunk-size games at a time), each with
+    its own database connections. The CSV comes out in the same order either way
 """
-import sys, os, psycopg2, psycopg2.extras, pprint
+import sys, os, json, tempfile, psycopg2, psycopg2.extras, psycopg2.pool, pprint, argparse
 import pandas as pd
-from build_db import nflscraper
+from build_db import nflscraper, descriptor_matcher, has_table
+from feature_engine import feature_engine
+from training_data import write_training_data, write_chunks
 from statistics import mean
 from datetime import datetime
 from tqdm import tqdm
 from dotenv import load_dotenv
 from typing import Union
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 class nfldb():
     __supported_features = {
@@ -23,21 +46,49 @@ class nfldb():
         "player": ["adjqbr", "passingyards", "rushingyards", "fumbles", "totaltackles", "sacks", "interceptions", "qbhits"], # player features will be found in the boxscores
         "game": ["temperature", "precipitation"] # game statistics will be team-independent (i.e. weather)
     }
-    def __init__(self, db, host, user, password, port):
+    def __init__(self, db, host, user, password, port, pool_size=4):
         self.__database = db
         self.__host = host
         self.__user = user
         self.__password = password
         self.__port = port
+        # connections are opened once and handed out to every query (and thread) from here
+        self.__pool = None
+        self.__rollup = False
+        self.__rollup_complete = {} # (since_year, end_year): whether teamgame has every game in those seasons
         try:
-            connection = self.__connect() 
-            connection.cursor().execute("SELECT 1;")
-            connection.commit()
+            self.__pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size, dbname=self.__database, host=self.__host, 
+                user=self.__user, password=self.__password, port=self.__port)
+            with self.__cursor() as cursor:
+                cursor.execute("SELECT 1;")
             print("Connection to Database: Valid")
+            # per team per game boxscore totals, if build_db.py has been keeping them (otherwise we sum gameplayer ourselves)
+            with self.__cursor(cursor_factory=None) as cursor:
+                self.__rollup = has_table(cursor, "teamgame")
+            if not self.__rollup: print("There's no teamgame table (see build_db.py --backfill-teamgame), summing gameplayer rows instead")
         except Exception as e:
-            print("Error connecting to database: {e}")
-    def __connect(self):
-        return psycopg2.connect(dbname=self.__database, host=self.__host, user=self.__user, password=self.__password, port=self.__port)
+            print(f"Error connecting to database: {e}")
+    def get_supported_features():
+        return nfldb.__supported_features
+    def get_training_data_columns(agg_method: str, features: dict = __supported_features) -> list[str]:
+        return nfldb.__training_data_columns(features, agg_method)
+    @contextmanager
+    def __cursor(self, cursor_factory=psycopg2.extras.RealDictCursor, name: str = None, itersize: int = 2000):
+        """Borrows a connection from the pool for the duration of a with block. A named cursor is a server-side
+        one: iterating over it fetches itersize rows at a time instead of the whole result at once."""
+        conn = self.__pool.getconn()
+        try:
+            with conn.cursor(name=name, cursor_factory=cursor_factory) as cursor:
+                if name is not None: cursor.itersize = itersize
+                yield cursor
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.__pool.putconn(conn)
+    def close(self):
+        if self.__pool is not None: self.__pool.closeall()
     def __filter_by_team(game_list: list[dict], team_id: int, feature: str) -> list:
         """Filter a list of games by team id and return a list of values for a particular feature"""
         result = []
@@ -79,67 +130,82 @@ class nfldb():
         return home_stats, away_stats
     def __discounted_sum(arr: list, discount_factor: float) -> float:
         return sum([(v * (discount_factor ** i)) for i, v in enumerate(arr)])
+    def __use_rollup(self, player_features: list[str], since_year: int = None, end_year: int = None) -> bool:
+        """Whether the teamgame rollup has every one of these features, and a row for every game from since_year to
+        end_year (all of them if they aren't given). Games collected before the table was created don't have one until
+        build_db.py --backfill-teamgame, and reading teamgame then would quietly turn their stats into 0s."""
+        if not self.__rollup or not set(player_features) <= set(nflscraper.get_rollup_features()): return False
+        seasons = (since_year or 0, end_year)
+        if seasons not in self.__rollup_complete:
+            with self.__cursor(cursor_factory=None) as cursor:
+                cursor.execute("""SELECT 
+                    (SELECT count(DISTINCT game) FROM teamgame WHERE season >= %(since)s AND (%(end)s IS NULL OR season <= %(end)s)),
+                    (SELECT count(*) FROM game WHERE season >= %(since)s AND (%(end)s IS NULL OR season <= %(end)s))""",
+                    {"since": seasons[0], "end": end_year})
+                rolled_up, games = cursor.fetchone()
+            if rolled_up != games:
+                print(f"teamgame only has {rolled_up} of the {games} games from {seasons[0]} to {end_year or 'now'} "
+                      "(see build_db.py --backfill-teamgame), summing gameplayer rows instead")
+            self.__rollup_complete[seasons] = rolled_up == games
+        return self.__rollup_complete[seasons]
     def get_game(self, game_id: int):
-        conn = self.__connect()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cursor.execute(f"""SELECT * FROM game WHERE id = {game_id}""")
-        result = cursor.fetchone()
-        conn.close()
+        with self.__cursor() as cursor:
+            cursor.execute("SELECT * FROM game WHERE id = %s", (game_id,))
+            result = cursor.fetchone()
         return dict(result)
     def get_n_previous_games(self, game_id: int, n: int) -> list[dict]:
-        conn = self.__connect()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cursor.execute(f"""
-        WITH 
-        game_info AS (
-            SELECT gameday, home_team_id, away_team_id FROM game WHERE id = {game_id}
-        )
-        (SELECT * FROM game WHERE 
-            gameday < (SELECT gameday FROM game_info) AND
-            (home_team_id = (SELECT home_team_id FROM game_info) 
-            OR away_team_id = (SELECT home_team_id FROM game_info))
-        LIMIT {n})
-
-        UNION
-
-        (SELECT * FROM game
-        WHERE 
-            gameday < (SELECT gameday FROM game_info) AND
-            (home_team_id = (SELECT away_team_id FROM game_info)
-            OR away_team_id = (SELECT away_team_id FROM game_info))
-        LIMIT {n});
-        """)
-        result = cursor.fetchall()
-        conn.close()
-        return [dict(row) for row in result]
-    def get_previous_game_boxscores(self, game_id: int, n: int) -> list[dict]:
-        conn = self.__connect()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cursor.execute(f"""
-        WITH 
-        game_info AS (
-            SELECT gameday, home_team_id, away_team_id FROM game WHERE id = {game_id}
-        ),
-        prev_games AS ((
-            SELECT id FROM game WHERE 
+        with self.__cursor() as cursor:
+            cursor.execute("""
+            WITH 
+            game_info AS (
+                SELECT gameday, home_team_id, away_team_id FROM game WHERE id = %(game_id)s
+            )
+            (SELECT * FROM game WHERE 
                 gameday < (SELECT gameday FROM game_info) AND
                 (home_team_id = (SELECT home_team_id FROM game_info) 
                 OR away_team_id = (SELECT home_team_id FROM game_info))
-            LIMIT {n})
+            LIMIT %(n)s)
 
             UNION
 
-            (SELECT id FROM game
+            (SELECT * FROM game
             WHERE 
                 gameday < (SELECT gameday FROM game_info) AND
                 (home_team_id = (SELECT away_team_id FROM game_info)
                 OR away_team_id = (SELECT away_team_id FROM game_info))
-            LIMIT {n})
-        )
-        SELECT * FROM gameplayer WHERE game IN (SELECT id FROM prev_games);
-        """)
-        result = cursor.fetchall();
-        conn.close()
+            LIMIT %(n)s);
+            """, {"game_id": game_id, "n": n})
+            result = cursor.fetchall()
+        return [dict(row) for row in result]
+    def get_previous_game_boxscores(self, game_id: int, n: int) -> list[dict]:
+        """Boxscores for the previous n games of both teams: one row per team per game from the teamgame
+        rollup when it has every game, otherwise every player's row (__filter_boxscores_by_team sums either)"""
+        table = "teamgame" if self.__use_rollup(nfldb.__supported_features["player"]) else "gameplayer"
+        with self.__cursor() as cursor:
+            cursor.execute(f"""
+            WITH 
+            game_info AS (
+                SELECT gameday, home_team_id, away_team_id FROM game WHERE id = %(game_id)s
+            ),
+            prev_games AS ((
+                SELECT id FROM game WHERE 
+                    gameday < (SELECT gameday FROM game_info) AND
+                    (home_team_id = (SELECT home_team_id FROM game_info) 
+                    OR away_team_id = (SELECT home_team_id FROM game_info))
+                LIMIT %(n)s)
+
+                UNION
+
+                (SELECT id FROM game
+                WHERE 
+                    gameday < (SELECT gameday FROM game_info) AND
+                    (home_team_id = (SELECT away_team_id FROM game_info)
+                    OR away_team_id = (SELECT away_team_id FROM game_info))
+                LIMIT %(n)s)
+            )
+            SELECT * FROM {table} WHERE game IN (SELECT id FROM prev_games);
+            """, {"game_id": game_id, "n": n})
+            result = cursor.fetchall()
         return [dict(row) for row in result]
     def aggregate_team_data(self, game: dict, 
         previous_games: list[dict] = None, 
@@ -160,6 +226,8 @@ class nfldb():
                 dict in the format { "feature": "agg_method" } will apply the given agg_method to a 
                 particular feature. The default aggregation method is "avg".
             features (List[str]): The features to extract from the local db.
+            weather_descriptors (dict|descriptor_matcher): {severity: [descriptors]} used to turn the
+                game's precipitation into a severity. Pass a descriptor_matcher to avoid rebuilding it every game.
 
         Returns:
             List[]: The feature that represents the game, with the last element in the list being 
@@ -215,13 +283,9 @@ class nfldb():
         
         for feature in features["game"]:
             if feature == "precipitation":
-                precip_severity = None
-                if game["precipitation"] is not None:
-                    for severity in weather_descriptors:
-                        for descriptor in weather_descriptors[severity]:
-                            if descriptor in game["precipitation"]:
-                                precip_severity = severity
-                result["precip_severity"] = precip_severity
+                if not isinstance(weather_descriptors, descriptor_matcher):
+                    weather_descriptors = descriptor_matcher(weather_descriptors)
+                result["precip_severity"] = weather_descriptors.severity(game["precipitation"])
             if feature == "temperature":
                 result["temperature"] = game["temperature"]
 
@@ -232,35 +296,388 @@ class nfldb():
         result["label"] = "Home" if game["home_score"] > game["away_score"] else "Away"
 
         return result
-    def generate_training_data(self, year: int) -> pd.DataFrame:
-        # collect a list of all games in the 2023 season
-        conn = self.__connect()
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        weather_cursor = conn.cursor()
-        weather_descriptors = nflscraper.load_descriptors(weather_cursor)
-        cursor.execute(f"""SELECT * FROM game WHERE season={year}""")
-        games = cursor.fetchall()
+    def history_start(start_year: int, n_prev_games: int) -> int:
+        """The earliest season that can hold one of the previous n games of a game in start_year (every team plays 16+ a season)"""
+        if n_prev_games is None: return 0 # the whole history
+        return start_year - (n_prev_games // 16 + 1)
+    def load_games(self, end_year: int, since_year: int = None) -> pd.DataFrame:
+        """Every game up to and including end_year (and from since_year on, if it's given), in one read"""
+        with self.__cursor() as cursor:
+            cursor.execute("SELECT * FROM game WHERE season BETWEEN %s AND %s", (since_year or 0, end_year))
+            return pd.DataFrame(cursor.fetchall())
+    def load_team_boxscores(self, end_year: int, player_features: list[str], since_year: int = None) -> pd.DataFrame:
+        """gameplayer stats summed per team per game (the database does the summing) up to and including end_year.
+        A team/game where nobody has a value for a stat gets NULL rather than 0, like __filter_boxscores_by_team."""
+        seasons = (since_year or 0, end_year)
+        with self.__cursor() as cursor:
+            if self.__use_rollup(player_features, since_year, end_year):
+                # already summed at ingest, so this is two rows per game
+                cursor.execute(f"SELECT game, team{''.join([f', {feature}' for feature in player_features])} FROM teamgame WHERE season BETWEEN %s AND %s", 
+                               seasons)
+            else:
+                sums = ", ".join([f"SUM(gp.{feature}) AS {feature}" for feature in player_features])
+                cursor.execute(f"""SELECT gp.game, gp.team{', ' if sums else ''}{sums} FROM gameplayer gp 
+                    JOIN game g ON g.id = gp.game WHERE g.season BETWEEN %s AND %s GROUP BY gp.game, gp.team""", seasons)
+            return pd.DataFrame(cursor.fetchall(), columns=["game", "team", *player_features])
+    def get_game_seasons(self, start_year: int, end_year: int) -> dict:
+        """{game id: season} for every game from start_year to end_year, in the order the games were played"""
+        with self.__cursor(cursor_factory=None) as cursor:
+            cursor.execute("SELECT id, season FROM game WHERE season BETWEEN %s AND %s ORDER BY gameday, id", (start_year, end_year))
+            return dict(cursor.fetchall())
+    def load_weather_matcher(self) -> descriptor_matcher:
+        with self.__cursor(cursor_factory=None) as cursor:
+            return descriptor_matcher(nflscraper.load_descriptors(cursor))
+    def generate_training_data_range(self, start_year: int, end_year: int, n_prev_games: int = 5, 
+        agg_method: str = "discounted_sum", features: dict = __supported_features, discount_factor: float = 0.9,
+        game_ids=None) -> pd.DataFrame:
+        """Same rows as generate_training_data for every season from start_year to end_year, but from two bulk
+        reads instead of two queries per game. Previous games are always each team's most recent n games.
+        Given game_ids, only those games' rows are built, and only the seasons they need are read."""
+        since_year = None if game_ids is None else nfldb.history_start(start_year, n_prev_games)
+        engine = feature_engine(self.load_games(end_year, since_year), self.load_team_boxscores(end_year, features["player"], since_year),
+                                features, self.load_weather_matcher())
+        return engine.generate(start_year, end_year, n_prev_games=n_prev_games, agg_method=agg_method, discount_factor=discount_factor,
+                               game_ids=game_ids)
+    def generate_training_data_sweep(self, start_year: int, end_year: int, configs: list[dict], 
+        features: dict = __supported_features):
+        """generate_training_data_range for many configs ({"n_prev_games", "agg_method", "discount_factor"}) from a single
+        read of the data. Yields (config, rows) one config at a time, so only one variant has to be in memory."""
+        engine = feature_engine(self.load_games(end_year), self.load_team_boxscores(end_year, features["player"]),
+                                features, self.load_weather_matcher())
+        for config in configs:
+            yield config, engine.generate(start_year, end_year, **config)
+    def __prior_games_sql(n_prev_games: int, agg_method: str, feature: str, discount_factor: float) -> str:
+        """SQL expression for one feature aggregated over a team's previous n games (window "team_games")"""
+        if agg_method == "discounted_sum":
+            # the most recent game has weight 1, the one before it discount_factor, then discount_factor**2...
+            return " + ".join([f"COALESCE(LAG({feature}, {k}) OVER team_games, 0) * {float(discount_factor) ** (k - 1)!r}" 
+                               for k in range(1, n_prev_games + 1)])
+        # avg and composite_avg (the difference is taken in the final select)
+        first = "UNBOUNDED" if n_prev_games is None else n_prev_games
+        return f"AVG({feature}) OVER (team_games ROWS BETWEEN {first} PRECEDING AND 1 PRECEDING)"
+    def __training_data_sql(self, start_year: int, end_year: int, n_prev_games: int, agg_method: str, features: dict,
+                            discount_factor: float, game_ids) -> tuple:
+        """The window function query behind generate_training_data_sql, and its parameters"""
+        if agg_method not in ["avg", "composite_avg", "discounted_sum"]:
+            raise ValueError(f"Unknown agg_method {agg_method}")
+        if n_prev_games is None and agg_method == "discounted_sum":
+            # it'd take a LAG per game in the history, use the vectorized engine for that
+            raise ValueError("The sql engine needs a limited n_prev_games for discounted_sum")
+        n_prev_games = None if n_prev_games is None else int(n_prev_games)
+        team_features, player_features = features["team"], features["player"]
+        aggregated = team_features + player_features
+        sides = [f"""SELECT g.id AS game, g.gameday, g.{side}_team_id AS team{''.join([f', g.{side}_{f} AS {f}' for f in team_features])}
+                     FROM game g WHERE g.season BETWEEN %(since_year)s AND %(end_year)s""" for side in ("home", "away")]
+        params = {"start_year": start_year, "end_year": end_year, "since_year": 0}
+        if game_ids is not None:
+            params |= {"game_ids": list(game_ids), "since_year": nfldb.history_start(start_year, n_prev_games)}
+        if self.__use_rollup(player_features, params["since_year"], end_year):
+            team_boxscore = f"SELECT game, team{''.join([f', {f}' for f in player_features])} FROM teamgame WHERE season BETWEEN %(since_year)s AND %(end_year)s"
+        else:
+            team_boxscore = f"""SELECT gp.game, gp.team{''.join([f', SUM(gp.{f}) AS {f}' for f in player_features])} FROM gameplayer gp
+            JOIN game g ON g.id = gp.game WHERE g.season BETWEEN %(since_year)s AND %(end_year)s GROUP BY gp.game, gp.team"""
+        priors = ",\n".join([f"COALESCE({nfldb.__prior_games_sql(n_prev_games, agg_method, f, discount_factor)}, 0) AS {f}" for f in aggregated])
+        if agg_method == "composite_avg":
+            # negative number indicates favor of home team, positive number indicates favor of away team
+            columns = [f"a.{f} - h.{f} AS {f}" for f in aggregated]
+        else:
+            columns = [column for f in aggregated for column in (f"h.{f} AS home_{f}", f"a.{f} AS away_{f}")]
+        columns += ["g.temperature", "g.precipitation", "g.id AS game_id", 
+                    "CASE WHEN g.home_score > g.away_score THEN 'Home' ELSE 'Away' END AS label"]
+        query = f"""
+        WITH
+        team_game AS ({sides[0]} UNION ALL {sides[1]}),
+        team_boxscore AS ({team_boxscore}),
+        timeline AS (
+            SELECT tg.*{''.join([f', tb.{f}' for f in player_features])} FROM team_game tg
+            LEFT JOIN team_boxscore tb ON tb.game = tg.game AND tb.team = tg.team
+        ),
+        prior AS (
+            SELECT game, team, {priors}
+            FROM timeline
+            WINDOW team_games AS (PARTITION BY team ORDER BY gameday, game)
+        )
+        SELECT {', '.join(columns)}
+        FROM game g
+        JOIN prior h ON h.game = g.id AND h.team = g.home_team_id
+        JOIN prior a ON a.game = g.id AND a.team = g.away_team_id
+        WHERE g.season BETWEEN %(start_year)s AND %(end_year)s{'' if game_ids is None else ' AND g.id = ANY(%(game_ids)s)'}
+        ORDER BY g.gameday, g.id;
+        """
+        return query, params
+    def __training_data_columns(features: dict, agg_method: str) -> list[str]:
+        """The columns (in order) of a row from aggregate_team_data"""
+        aggregated = features["team"] + features["player"]
+        columns = aggregated if agg_method == "composite_avg" else [c for f in aggregated for c in (f"home_{f}", f"away_{f}")]
+        for feature in features["game"]:
+            if feature == "precipitation": columns.append("precip_severity")
+            if feature == "temperature": columns.append("temperature")
+        return columns + ["game_id", "label"]
+    def generate_training_data_sql(self, start_year: int, end_year: int, n_prev_games: int = 5, 
+        agg_method: str = "discounted_sum", features: dict = __supported_features, discount_factor: float = 0.9,
+        game_ids=None) -> pd.DataFrame:
+        """Same rows as generate_training_data_range, but the database computes every game's aggregates in a
+        single query: window functions over each team's games (see the game/gameplayer indexes in nfl_create.sql)"""
+        query, params = self.__training_data_sql(start_year, end_year, n_prev_games, agg_method, features, discount_factor, game_ids)
+        with self.__cursor() as cursor:
+            cursor.execute(query, params)
+            result = pd.DataFrame(cursor.fetchall(), columns=[desc[0] for desc in cursor.description])
+
+        # precipitation severity and column order are finished up here, to match aggregate_team_data
+        matcher = self.load_weather_matcher()
+        result["precip_severity"] = [matcher.severity(p) for p in result["precipitation"]]
+        return result[nfldb.__training_data_columns(features, agg_method)]
+    def stream_training_data_sql(self, start_year: int, end_year: int, n_prev_games: int = 5, 
+        agg_method: str = "discounted_sum", features: dict = __supported_features, discount_factor: float = 0.9,
+        game_ids=None, itersize: int = 2000):
+        """generate_training_data_sql one row (dict) at a time, read through a server-side cursor itersize rows at a time"""
+        query, params = self.__training_data_sql(start_year, end_year, n_prev_games, agg_method, features, discount_factor, game_ids)
+        matcher = self.load_weather_matcher()
+        columns = nfldb.__training_data_columns(features, agg_method)
+        with self.__cursor(name="training_data_sql", itersize=itersize) as cursor:
+            cursor.execute(query, params)
+            for row in cursor:
+                row["precip_severity"] = matcher.severity(row["precipitation"])
+                yield {column: row[column] for column in columns}
+    def generate_training_data(self, year: int, n_prev_games: int = 5, agg_method: str = "discounted_sum", 
+                               discount_factor: float = 0.9, game_ids=None) -> pd.DataFrame:
+        # collect a list of all games in the season (or just the ones in game_ids)
+        weather_descriptors = self.load_weather_matcher()
+        with self.__cursor() as cursor:
+            if game_ids is None:
+                cursor.execute("SELECT * FROM game WHERE season = %s", (year,))
+            else:
+                cursor.execute("SELECT * FROM game WHERE season = %s AND id = ANY(%s)", (year, list(game_ids)))
+            games = cursor.fetchall()
         objects = []
         for game in tqdm(games, desc=f"Generating {year} Features..."):
-            objects.append(self.aggregate_team_data(game, agg_method="discounted_sum", weather_descriptors=weather_descriptors))
-        conn.close()
+            objects.append(self.aggregate_team_data(game, n_prev_games=n_prev_games, agg_method=agg_method, 
+                                                    weather_descriptors=weather_descriptors, discount_factor=discount_factor))
         return pd.DataFrame(objects)
+    def stream_training_data(self, year: int, n_prev_games: int = 5, agg_method: str = "discounted_sum", 
+                             discount_factor: float = 0.9, game_ids=None, itersize: int = 2000):
+        """generate_training_data one game (dict) at a time, in game order. The season's games come through a
+        server-side cursor, and aggregate_team_data's queries borrow another connection from the pool meanwhile."""
+        weather_descriptors = self.load_weather_matcher()
+        with self.__cursor(name=f"games_{year}", itersize=itersize) as cursor:
+            if game_ids is None:
+                cursor.execute("SELECT * FROM game WHERE season = %s ORDER BY gameday, id", (year,))
+            else:
+                cursor.execute("SELECT * FROM game WHERE season = %s AND id = ANY(%s) ORDER BY gameday, id", (year, list(game_ids)))
+            for game in cursor:
+                yield self.aggregate_team_data(game, n_prev_games=n_prev_games, agg_method=agg_method, 
+                                               weather_descriptors=weather_descriptors, discount_factor=discount_factor)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Generate ML friendly training data from the NFL database")
+    parser.add_argument("start_year", nargs="?", default=2015, type=lambda y: datetime.strptime(y, "%Y").year)
+    parser.add_argument("end_year", nargs="?", default=2023, type=lambda y: datetime.strptime(y, "%Y").year)
+    parser.add_argument("--engine", choices=["vectorized", "sql", "query"], default="vectorized",
+                        help="vectorized: a couple of bulk reads for the whole range, sql: one window function query "
+                             "that has the database do the aggregation, query: two queries per game")
+    # each of these can be given several values, which sweeps every combination of them
+    parser.add_argument("--n-prev-games", type=lambda n: None if n == "all" else int(n), nargs="+", default=[5], 
+                        help="number of previous games to aggregate per team, or \"all\" for each team's whole history")
+    parser.add_argument("--agg-method", choices=["avg", "composite_avg", "discounted_sum"], nargs="+", default=["discounted_sum"])
+    parser.add_argument("--discount-factor", type=float, nargs="+", default=[0.9], help="weight decay per game for discounted_sum")
+    parser.add_argument("--pool-size", type=int, default=4, help="max number of open database connections")
+    parser.add_argument("--append", action="store_true",
+                        help="only compute games that aren't in the existing CSV yet and add them to the end of it")
+    parser.add_argument("--format", choices=["csv", "parquet", "feather", "npy"], default="csv",
+                        help="output format, see training_data.py (parquet/feather need pyarrow)")
+    parser.add_argument("--stream", action="store_true",
+                        help="write rows as they're computed instead of building the whole export in memory (sql/query engines)")
+    parser.add_argument("--chunk-rows", type=int, default=10000, help="rows written at a time with --stream")
+    parser.add_argument("--itersize", type=int, default=2000, help="rows fetched per round trip by --stream's server-side cursors")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of worker processes, each computing a share of the games (default 1: no workers)")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="games per worker task (default: one task per season)")
+    return parser.parse_args(argv)
+
+def read_export_meta(path: str, config: dict):
+    """The sidecar written next to an export by write_export_meta, or None if the export can't be appended to
+    (missing, made with a different config, or changed since)"""
+    try:
+        with open(path + ".meta.json") as f:
+            meta = json.load(f)
+        size = os.path.getsize(path)
+    except (OSError, ValueError):
+        return None
+    if meta.get("config") != config:
+        print(f"{path} was generated with different options, rebuilding it")
+        return None
+    if size < meta["size"]:
+        return None
+    if size > meta["size"]:
+        # rows from an append that died before its sidecar was written, they get computed again
+        with open(path, "r+b") as f:
+            f.truncate(meta["size"])
+    return meta
+
+def write_export_meta(path: str, config: dict, game_ids: list):
+    """Records what's in an export (the config and game ids, plus the file size so a half written append can be undone)"""
+    meta = {"config": config, "size": os.path.getsize(path), "game_ids": game_ids}
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, path + ".meta.json")
 
-def main(start_year=2015, end_year=2023):
+def open_db(pool_size: int = 4) -> nfldb:
     load_dotenv()
-    db = nfldb(
+    return nfldb(
         db=os.getenv("NFL_DB_NAME"),
         host=os.getenv("NFL_DB_HOST"),
         user=os.getenv("NFL_DB_USER"),
         password=os.getenv("NFL_DB_PASS"),
-        port=os.getenv("NFL_DB_PORT")
+        port=os.getenv("NFL_DB_PORT"),
+        pool_size=pool_size
     )
 
-    training = pd.concat([db.generate_training_data(year) for year in range(start_year, end_year+1)])
-    training.to_csv(f"nfl{start_year}_{end_year}.csv", index=False)
+def generate(db: nfldb, engine: str, start_year: int, end_year: int, config: dict, game_ids=None) -> pd.DataFrame:
+    if engine == "vectorized":
+        return db.generate_training_data_range(start_year, end_year, **config, game_ids=game_ids)
+    if engine == "sql":
+        return db.generate_training_data_sql(start_year, end_year, **config, game_ids=game_ids)
+    return pd.concat([db.generate_training_data(year, **config, game_ids=game_ids) for year in range(start_year, end_year+1)])
+
+def stream(db: nfldb, engine: str, start_year: int, end_year: int, config: dict, game_ids=None, itersize: int = 2000):
+    """Like generate, but yields one row at a time (only the sql and query engines can)"""
+    if engine == "sql":
+        yield from db.stream_training_data_sql(start_year, end_year, **config, game_ids=game_ids, itersize=itersize)
+    elif engine == "query":
+        for year in range(start_year, end_year + 1):
+            yield from db.stream_training_data(year, **config, game_ids=game_ids, itersize=itersize)
+    else:
+        raise ValueError(f"The {engine} engine can't stream, use sql or query")
+
+def generate_shard(engine: str, start_year: int, end_year: int, config: dict, game_ids: list, pool_size: int) -> pd.DataFrame:
+    """Runs in a worker process, with its own connections"""
+    db = open_db(pool_size)
+    try:
+        return generate(db, engine, start_year, end_year, config, game_ids)
+    finally:
+        db.close()
+
+def make_shards(seasons: dict, game_ids: list, chunk_size: int = None) -> list[tuple]:
+    """Splits game_ids (in game order) into (start_year, end_year, game_ids) shards: one per season, or
+    chunk_size consecutive games each"""
+    if chunk_size is None:
+        by_season = {}
+        for game in game_ids: by_season.setdefault(seasons[game], []).append(game)
+        return [(season, season, games) for season, games in by_season.items()]
+    chunks = [game_ids[i:i + chunk_size] for i in range(0, len(game_ids), chunk_size)]
+    return [(seasons[chunk[0]], seasons[chunk[-1]], chunk) for chunk in chunks]
+
+def generate_parallel(engine: str, seasons: dict, game_ids: list, config: dict, processes: int, chunk_size: int = None,
+                      pool_size: int = 4) -> pd.DataFrame:
+    """Computes the rows for game_ids across a process pool. Every game's features only depend on the games
+    before it, so the shards are independent; the result is in the same order as game_ids whatever order they finish in."""
+    shards = make_shards(seasons, game_ids, chunk_size)
+    results = [None] * len(shards)
+    with ProcessPoolExecutor(max_workers=min(processes, len(shards))) as pool:
+        futures = {pool.submit(generate_shard, engine, start, end, config, games, pool_size): i 
+                   for i, (start, end, games) in enumerate(shards)}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Generating shards..."):
+            results[futures[future]] = future.result()
+    training = pd.concat(results, ignore_index=True)
+    # the query engine doesn't order its rows
+    order = {game: i for i, game in enumerate(game_ids)}
+    return training.sort_values("game_id", key=lambda ids: ids.map(order), kind="stable").reset_index(drop=True)
+
+def sweep_configs(n_prev_games: list, agg_methods: list[str], discount_factors: list[float]) -> list[dict]:
+    """Every combination of the options (the discount factor only matters to discounted_sum)"""
+    configs = []
+    for n in n_prev_games:
+        for agg_method in agg_methods:
+            for discount_factor in (discount_factors if agg_method == "discounted_sum" else discount_factors[:1]):
+                configs.append({"n_prev_games": n, "agg_method": agg_method, "discount_factor": discount_factor})
+    return configs
+
+def sweep(start_year: int, end_year: int, configs: list[dict], pool_size: int = 4, format: str = "csv"):
+    """Writes one export per config, nfl{start}_{end}_n{N}_{agg_method}[_d{D}].{format}, all from one read of the database"""
+    db = open_db(pool_size)
+    for config, training in tqdm(db.generate_training_data_sweep(start_year, end_year, configs), total=len(configs), desc="Sweeping..."):
+        suffix = f"n{config['n_prev_games'] or 'all'}_{config['agg_method']}"
+        if config["agg_method"] == "discounted_sum": suffix += f"_d{config['discount_factor']}"
+        path = f"nfl{start_year}_{end_year}_{suffix}.{format}"
+        export_config = config | {"features": nfldb.get_supported_features()}
+        if format == "csv":
+            training.to_csv(path, index=False)
+            write_export_meta(path, export_config, [int(game) for game in training["game_id"]])
+        else:
+            write_training_data(training, path, export_config | {"seasons": [start_year, end_year]})
+    db.close()
+
+def main(start_year=2015, end_year=2023, engine="vectorized", n_prev_games=5, agg_method="discounted_sum", discount_factor=0.9,
+         pool_size=4, append=False, processes=1, chunk_size=None, format="csv", streaming=False, chunk_rows=10000, itersize=2000):
+    if append and format != "csv":
+        print("--append only works with csv output, the other formats are rewritten in one go")
+        sys.exit(1)
+    if streaming and (engine == "vectorized" or processes > 1 or format == "npy"):
+        print("--stream needs --engine sql or query, a single process, and csv/parquet/feather output")
+        sys.exit(1)
+    if engine == "sql" and n_prev_games is None and agg_method == "discounted_sum":
+        print("--engine sql can't take a discounted_sum over --n-prev-games all (it'd need a LAG per game), use the vectorized engine or a number of games")
+        sys.exit(1)
+    # the server-side cursor keeps a connection busy while the query engine needs another one for each game
+    if streaming: pool_size = max(pool_size, 2)
+    db = open_db(pool_size)
+
+    config = {"n_prev_games": n_prev_games, "agg_method": agg_method, "discount_factor": discount_factor}
+    path = f"nfl{start_year}_{end_year}.{format}"
+    # anything that changes the columns or values means the export has to be rebuilt, the engine doesn't
+    export_config = config | {"features": nfldb.get_supported_features()}
+    meta = read_export_meta(path, export_config) if append else None
+    game_ids = None
+    if meta is not None or processes > 1:
+        seasons = db.get_game_seasons(start_year, end_year)
+        exported = set(meta["game_ids"]) if meta is not None else set()
+        game_ids = [game for game in seasons if game not in exported]
+        if len(game_ids) == 0:
+            print(f"{path} is up to date")
+            db.close()
+            return
+        # only the seasons with new games need to be looked at
+        start_year = min(seasons[game] for game in game_ids)
+        if meta is not None: print(f"Appending {len(game_ids)} new games to {path}")
+
+    if streaming:
+        # rows go straight from the cursor to the file, chunk_rows at a time
+        rows = tqdm(stream(db, engine, start_year, end_year, config, game_ids, itersize), desc="Streaming rows...")
+        written = write_chunks(rows, path, export_config | {"seasons": [start_year, end_year]}, chunk_rows, append=meta is not None,
+                               columns=nfldb.get_training_data_columns(agg_method))
+        if format == "csv":
+            write_export_meta(path, export_config, (meta["game_ids"] if meta is not None else []) + written)
+        db.close()
+        return
+    if processes > 1:
+        training = generate_parallel(engine, seasons, game_ids, config, processes, chunk_size, pool_size)
+    else:
+        training = generate(db, engine, start_year, end_year, config, game_ids)
+    if format != "csv":
+        write_training_data(training, path, export_config | {"seasons": [start_year, end_year]})
+        db.close()
+        return
+    if meta is None:
+        training.to_csv(path, index=False)
+        exported = []
+    else:
+        training.to_csv(path, mode="a", header=False, index=False)
+        exported = meta["game_ids"]
+    write_export_meta(path, export_config, exported + [int(game) for game in training["game_id"]])
+    db.close()
 
 if __name__ == "__main__":
-    start_year = datetime.strptime(sys.argv[1], "%Y").year if len(sys.argv) > 1 else 2015
-    end_year = datetime.strptime(sys.argv[2], "%Y").year if len(sys.argv) > 2 else 2023
-    main(start_year=start_year, end_year=end_year)
-    sys.exit()
\ No newline at end of file
+    args = parse_args(sys.argv[1:])
+    configs = sweep_configs(args.n_prev_games, args.agg_method, args.discount_factor)
+    if len(configs) > 1:
+        if args.append or args.processes > 1 or args.engine != "vectorized":
+            print("Sweeps always use the vectorized engine in one process, and can't be appended to")
+            sys.exit(1)
+        sweep(args.start_year, args.end_year, configs, pool_size=args.pool_size, format=args.format)
+    else:
+        main(start_year=args.start_year, end_year=args.end_year, engine=args.engine, pool_size=args.pool_size, append=args.append,
+             processes=args.processes, chunk_size=args.chunk_size, format=args.format, streaming=args.stream,
+             chunk_rows=args.chunk_rows, itersize=args.itersize, **configs[0])
+    sys.exit()
@@ -1,35 +1,82 @@
-import sys
+import sys, argparse, tempfile
 import pandas as pd
-from tqdm import tqdm
 from sklearn.svm import SVC
 from sklearn.model_selection import GridSearchCV
-from sklearn.metrics import f1_score
-import train_model #preprocess method
+from sklearn.experimental import enable_halving_search_cv # noqa: F401 (makes HalvingGridSearchCV importable)
+from sklearn.model_selection import HalvingGridSearchCV
+from training_data import load_training_data
+from kernel_cache import kernel_cache, cached_svc
 
-def main():
-    csv_data = pd.read_csv("data/nfl.csv")
-    X, y = train_model.preprocess(csv_data)
-    #TODO: answer the question: will increasing the amount of data change the optimal parameters?
-    svm_params = {
-        "C": [0.001, 0.01, 0.1, 1, 10, 100], 
-        "gamma": [0.001, 0.01, 0.1, 1, 10, 100],  # all kernels except linear
-        "kernel": ["linear", "poly", "rbf", "sigmoid"],
-        "degree": [2, 3, 4, 5] # only poly
-    }
-    num_configurations = 1;
-    for param in svm_params:
-        num_configurations *= len(svm_params[param])
-    print(f"Total Configurations: {num_configurations}")
-    svm, svm_score, svm_acc = SVC(), [], []
-    # GridSearch automatically does 5 fold cross validation
-    svm = GridSearchCV(svm, svm_params, n_jobs=-1, scoring="f1", verbose=2)
-        
+#TODO: answer the question: will increasing the amount of data change the optimal parameters?
+svm_params = {
+    "C": [0.001, 0.01, 0.1, 1, 10, 100],
+    "gamma": [0.001, 0.01, 0.1, 1, 10, 100],  # all kernels except linear
+    "kernel": ["linear", "poly", "rbf", "sigmoid"],
+    "degree": [2, 3, 4, 5] # only poly
+}
+
+def search_space(params: dict = svm_params) -> list[dict]:
+    """One grid per kernel with only the parameters that kernel uses, since SVC ignores gamma for linear and degree
+    for everything but poly (the full product of svm_params fits every one of those duplicates again)"""
+    uses = {"linear": ["C"], "rbf": ["C", "gamma"], "sigmoid": ["C", "gamma"], "poly": ["C", "gamma", "degree"]}
+    return [{"kernel": [kernel]} | {param: params[param] for param in uses[kernel]} for kernel in params["kernel"]]
+
+def num_configurations(space: list[dict]) -> int:
+    total = 0
+    for grid in space:
+        configurations = 1
+        for param in grid:
+            configurations *= len(grid[param])
+        total += configurations
+    return total
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Grid search over SVC's kernels and their parameters")
+    parser.add_argument("path", help="training data exported by generate_csv.py (.csv, .parquet, .feather or .npy)")
+    parser.add_argument("--halving", action="store_true",
+                        help="successive halving: score every config on a slice of the games, and only refit the best third on 3x as many")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--n-jobs", type=int, default=-1)
+    parser.add_argument("--seed", type=int, default=0, help="seeds the halving rounds' subsamples")
+    parser.add_argument("--no-kernel-cache", action="store_true",
+                        help="let SVC compute its kernel for every fit, instead of computing each kernel matrix once (kernel_cache.py)")
+    parser.add_argument("--kernel-dir", default=None,
+                        help="keep the kernel matrices in memory-mapped .npy files here and reuse them next run (with --n-jobs other "
+                             "than 1 they go in a temporary directory otherwise)")
+    parser.add_argument("--results", default="svm_grid_search.csv", help="where every config's scores and fit/score times are written")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    X, y = load_training_data(args.path)
+    space = search_space()
+    print(f"Total Configurations: {num_configurations(space)}")
+    estimator, scratch = SVC(), None
+    if not args.no_kernel_cache:
+        kernel_dir = args.kernel_dir
+        if kernel_dir is None and args.n_jobs != 1:
+            # the search's worker processes map the matrices from files, instead of being sent all of them with every fit
+            scratch = tempfile.TemporaryDirectory(prefix="svm_kernels_")
+            kernel_dir = scratch.name
+        # every (kernel, gamma, degree) matrix is computed once here, and each fit (any C, any fold) slices its
+        # rows out of it, so the search is given row numbers instead of features
+        cache = kernel_cache(X, kernel_dir)
+        cache.precompute(space)
+        estimator, X = cached_svc(cache), cache.rows()
+    if args.halving:
+        svm = HalvingGridSearchCV(estimator, space, cv=args.folds, n_jobs=args.n_jobs, scoring="f1",
+                                  random_state=args.seed, verbose=2)
+    else:
+        # GridSearch automatically does 5 fold cross validation
+        svm = GridSearchCV(estimator, space, cv=args.folds, n_jobs=args.n_jobs, scoring="f1", verbose=2)
     svm.fit(X, y)
+    if scratch is not None: scratch.cleanup()
 
-    print(svm.get_params())
-    
+    # mean/std_fit_time and mean/std_score_time are in there too (and the iteration/n_resources for halving)
+    pd.DataFrame(svm.cv_results_).sort_values("rank_test_score").to_csv(args.results, index=False)
+    print(f"Best Params: {svm.best_params_}")
+    print(f"Best F1: {svm.best_score_:.4f}")
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv[1:])
     sys.exit()
-
@@ -0,0 +1,112 @@
+"""
+============================
+===    kernel_cache.py   ===
+============================
+SVC's kernel matrix only depends on the kernel and its gamma/degree, not on C or on which fold is being fit, so it can
+be computed once for all of the data and sliced per fold: K[train, train] to fit SVC(kernel="precomputed") and
+K[test, train] to predict. kernel_cache computes each (kernel, gamma, degree) matrix once, in float32, and keeps it in
+memory or, given a directory, in an .npy file that's memory-mapped (so worker processes share one copy, and reruns on
+the same data skip computing it). cached_svc is an SVC built on top of it that grid searches can use like any other.
+Sent to another process (e.g. by joblib), a cache with a directory is just that directory: the worker maps the files
+by path instead of being sent a copy of every matrix.
+"""
+import os, hashlib
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.metrics.pairwise import pairwise_kernels
+from sklearn.svm import SVC
+
+class kernel_cache():
+    def __init__(self, X, directory: str = None):
+        """
+        Args:
+            X: the full (preprocessed) feature matrix, every fold's rows are row numbers into it
+            directory (str): where to keep the matrices as .npy files, None to keep them in memory
+        """
+        self.__X = np.ascontiguousarray(np.asarray(X, dtype=np.float32))
+        self.__directory = directory
+        self.__kernels = {}
+        # the files are named after the data too, so a different export never picks up the wrong matrix
+        self.__data_hash = hashlib.sha1(self.__X.tobytes()).hexdigest()[:12]
+        # what gamma="scale"/"auto" need, kept on their own so a pickled cache can resolve them without X
+        self.__n_rows, self.__n_features = self.__X.shape
+        self.__variance = float(self.__X.var())
+        if directory is not None: os.makedirs(directory, exist_ok=True)
+    def __deepcopy__(self, memo):
+        # sklearn's clone deep copies estimator params, but the matrices are read only and should be shared
+        return self
+    def __getstate__(self):
+        # only where the matrices are, so every worker maps the same files rather than unpickling its own copies
+        # (np.memmap pickles as a whole ndarray). They can't compute anything without X, so precompute() first.
+        if self.__directory is None:
+            raise TypeError("An in-memory kernel_cache can't be sent to another process, give it a directory")
+        return {"directory": self.__directory, "data_hash": self.__data_hash, "n_rows": self.__n_rows,
+                "n_features": self.__n_features, "variance": self.__variance}
+    def __setstate__(self, state):
+        self.__X, self.__kernels = None, {}
+        self.__directory, self.__data_hash = state["directory"], state["data_hash"]
+        self.__n_rows, self.__n_features, self.__variance = state["n_rows"], state["n_features"], state["variance"]
+    def __key(self, kernel: str, gamma, degree: int) -> tuple:
+        """(kernel, gamma, degree) with the ones the kernel ignores dropped, and gamma="scale"/"auto" resolved like SVC
+        does (though from all of the data rather than the training fold)"""
+        if kernel == "linear": return (kernel, None, None)
+        if gamma == "scale": gamma = 1.0 / (self.__n_features * self.__variance)
+        elif gamma == "auto": gamma = 1.0 / self.__n_features
+        return (kernel, float(gamma), degree if kernel == "poly" else None)
+    def kernel(self, kernel: str = "rbf", gamma="scale", degree: int = 3) -> np.ndarray:
+        """The (rows x rows) kernel matrix of the whole data set, computed the first time it's asked for"""
+        key = self.__key(kernel, gamma, degree)
+        if key not in self.__kernels:
+            self.__kernels[key] = self.__load(key) if self.__directory is not None else self.__compute(key)
+        return self.__kernels[key]
+    def __compute(self, key: tuple) -> np.ndarray:
+        kernel, gamma, degree = key
+        # (sklearn.metrics' poly and sigmoid kernels default to coef0=1, SVC's to 0)
+        params = {} if kernel == "linear" else {"gamma": gamma} | ({} if kernel == "rbf" else {"coef0": 0.0})
+        if kernel == "poly": params["degree"] = degree
+        return pairwise_kernels(self.__X, metric=kernel, **params).astype(np.float32, copy=False)
+    def __load(self, key: tuple) -> np.ndarray:
+        kernel, gamma, degree = key
+        path = os.path.join(self.__directory, f"{self.__data_hash}_{kernel}_gamma{gamma}_degree{degree}.npy")
+        if not os.path.exists(path):
+            if self.__X is None:
+                raise RuntimeError(f"{path} hasn't been computed, precompute() the kernels before sending the cache to other processes")
+            # written under another name first, so another process never maps a half written file
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f: np.save(f, self.__compute(key))
+            os.replace(tmp, path)
+        return np.load(path, mmap_mode="r")
+    def precompute(self, param_grid: list[dict]):
+        """Computes every kernel a search over param_grid (e.g. grid_search_svm.search_space()) will ask for up front,
+        so the search's worker processes get them already computed instead of each computing their own"""
+        for grid in param_grid:
+            for kernel in grid["kernel"]:
+                for gamma in grid.get("gamma", ["scale"]):
+                    for degree in grid.get("degree", [3]):
+                        self.kernel(kernel, gamma, degree)
+    def fold(self, train_idx, test_idx, kernel: str = "rbf", gamma="scale", degree: int = 3) -> tuple:
+        """(K[train, train], K[test, train]), what SVC(kernel="precomputed") fits and predicts on"""
+        K = self.kernel(kernel, gamma, degree)
+        return K[np.ix_(train_idx, train_idx)], K[np.ix_(test_idx, train_idx)]
+    def rows(self) -> np.ndarray:
+        """What to pass a search in place of X when it's fitting cached_svc: every row's row number"""
+        return np.arange(self.__n_rows).reshape(-1, 1)
+
+class cached_svc(ClassifierMixin, BaseEstimator):
+    """SVC that's given row numbers (kernel_cache.rows()) instead of features, and slices its kernel out of the
+    cache. Takes the same kernel/C/gamma/degree params as SVC, so it drops into GridSearchCV and friends unchanged."""
+    def __init__(self, cache: kernel_cache = None, C: float = 1.0, kernel: str = "rbf", gamma="scale", degree: int = 3):
+        self.cache = cache
+        self.C = C
+        self.kernel = kernel
+        self.gamma = gamma
+        self.degree = degree
+    def fit(self, rows, y):
+        self.rows_ = np.asarray(rows).ravel()
+        K = self.cache.kernel(self.kernel, self.gamma, self.degree)
+        self.svc_ = SVC(C=self.C, kernel="precomputed").fit(K[np.ix_(self.rows_, self.rows_)], y)
+        self.classes_ = self.svc_.classes_
+        return self
+    def predict(self, rows):
+        K = self.cache.kernel(self.kernel, self.gamma, self.degree)
+        return self.svc_.predict(K[np.ix_(np.asarray(rows).ravel(), self.rows_)])
@@ -15,22 +15,148 @@ class NN(nn.Module):
         x = torch.relu(self.fc1(x))
         x = self.fc2(x)
         return x
-    def fit(self, X, y, lr=0.01, epochs=1000):
+    def fit(self, X, y, lr=0.01, epochs=1000, batch_size=None, optimizer="sgd", validation_split=0.0, patience=None,
+            compile=False, seed=None):
+        """Trains on X (float32 features) and y (int64 labels). The defaults are the original full-batch SGD for a fixed
+        number of epochs.
+
+        Args:
+            batch_size (int): shuffled minibatches of this size each epoch (None: full batch)
+            optimizer (str): "sgd", "adam" or "adamw"
+            validation_split (float): fraction of the rows held out to decide when to stop
+            patience (int): stop once the validation loss hasn't improved for this many epochs, and keep the best
+                weights (needs a validation_split)
+            compile (bool): run the forward pass through torch.compile
+            seed (int): seeds the validation split and the shuffling
+        """
+        # moved once, not every epoch
         self.to(self.device)
+        X, y = X.to(self.device), y.to(self.device)
+        generator = torch.Generator(device="cpu")
+        if seed is not None: generator.manual_seed(seed)
+        else: generator.seed()
+        X_val, y_val = None, None
+        if validation_split > 0:
+            order = torch.randperm(len(X), generator=generator).to(self.device)
+            n_val = max(1, int(len(X) * validation_split))
+            X_val, y_val = X[order[:n_val]], y[order[:n_val]]
+            X, y = X[order[n_val:]], y[order[n_val:]]
+
         criterion = nn.CrossEntropyLoss()
-        optimizer = optim.SGD(self.parameters(), lr=lr)
+        optimizers = {"sgd": optim.SGD, "adam": optim.Adam, "adamw": optim.AdamW}
+        optimizer = optimizers[optimizer](self.parameters(), lr=lr)
+        model = torch.compile(self) if compile else self
+        batch_size = batch_size or len(X)
+        best_loss, best_state, stale = float("inf"), None, 0
+        self.train()
         for epoch in range(epochs):
-            X = X.to(self.device)
-            y = y.to(self.device)
-            outputs = self(X)
-            loss = criterion(outputs, y)
-
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            order = torch.randperm(len(X), generator=generator).to(self.device) if batch_size < len(X) else None
+            for start in range(0, len(X), batch_size):
+                batch = slice(start, start + batch_size) if order is None else order[start:start + batch_size]
+                loss = criterion(model(X[batch]), y[batch])
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+            if X_val is None or patience is None: continue
+            with torch.no_grad():
+                val_loss = criterion(model(X_val), y_val).item()
+            if val_loss < best_loss:
+                best_loss, stale = val_loss, 0
+                best_state = {name: value.detach().clone() for name, value in self.state_dict().items()}
+            else:
+                stale += 1
+                if stale >= patience: break
+        if best_state is not None: self.load_state_dict(best_state)
+        return self
     def predict(self, X):
         X = X.to(self.device)
+        was_training = self.training
         self.eval()
-        y_pred = self(X)
+        with torch.inference_mode():
+            y_pred = self(X)
+        self.train(was_training) # so fitting again afterwards is back in train mode
         _, predicted = torch.max(y_pred, 1)
-        return predicted.cpu().numpy()
\ No newline at end of file
+        return predicted.cpu().numpy()
+
+class BatchedNN(nn.Module):
+    """n_models independent copies of NN (input -> 10 -> 2) trained at the same time, as one batched matmul per layer
+    instead of one small model (and a few kernel launches) at a time. Every model sees the same X, and a boolean
+    mask per model picks out its training rows, e.g. one model per cross validation fold."""
+    def __init__(self, n_models, input_features, hidden=10, device="cpu"):
+        super(BatchedNN, self).__init__()
+        self.n_models = n_models
+        self.device = device
+        # initialized like nn.Linear: uniform in +/- 1/sqrt(fan_in)
+        def init(*shape, fan_in):
+            return nn.Parameter(torch.empty(n_models, *shape).uniform_(-fan_in ** -0.5, fan_in ** -0.5))
+        self.w1, self.b1 = init(input_features, hidden, fan_in=input_features), init(1, hidden, fan_in=input_features)
+        self.w2, self.b2 = init(hidden, 2, fan_in=hidden), init(1, 2, fan_in=hidden)
+    def forward(self, x):
+        # x: (rows, features), shared by every model -> (models, rows, 2)
+        x = x.unsqueeze(0).expand(self.n_models, -1, -1)
+        x = torch.relu(torch.baddbmm(self.b1, x, self.w1))
+        return torch.baddbmm(self.b2, x, self.w2)
+    def __losses(self, criterion, X, y, rows, masks):
+        """Each model's mean loss over its own rows among `rows`"""
+        outputs = self(X[rows])
+        losses = criterion(outputs.reshape(-1, 2), y[rows].repeat(self.n_models)).view(self.n_models, -1)
+        weights = masks[:, rows].float()
+        return (losses * weights).sum(1) / weights.sum(1).clamp(min=1)
+    def fit(self, X, y, train_masks, lr=0.01, epochs=1000, batch_size=None, optimizer="sgd", validation_split=0.0, 
+            patience=None, seed=None):
+        """Same options as NN.fit, with train_masks[i] (n_models x rows, bool) marking model i's training rows.
+        With early stopping each model keeps its own best weights, and stops learning once it runs out of patience."""
+        self.to(self.device)
+        X, y = X.to(self.device), y.to(self.device)
+        masks = torch.as_tensor(train_masks, dtype=torch.bool).to(self.device)
+        generator = torch.Generator(device="cpu")
+        if seed is not None: generator.manual_seed(seed)
+        else: generator.seed()
+        val_masks = None
+        if validation_split > 0:
+            # hold out validation_split of each model's own training rows
+            held_out = torch.rand(masks.shape, generator=generator).to(self.device) < validation_split
+            val_masks, masks = masks & held_out, masks & ~held_out
+
+        criterion = nn.CrossEntropyLoss(reduction="none")
+        optimizers = {"sgd": optim.SGD, "adam": optim.Adam, "adamw": optim.AdamW}
+        optimizer = optimizers[optimizer](self.parameters(), lr=lr)
+        batch_size = batch_size or len(X)
+        early_stopping = val_masks is not None and patience is not None
+        active = torch.ones(self.n_models, dtype=torch.bool, device=self.device)
+        best_loss = torch.full((self.n_models,), float("inf"), device=self.device)
+        best = [parameter.detach().clone() for parameter in self.parameters()]
+        stale = torch.zeros(self.n_models, dtype=torch.int64, device=self.device)
+        self.train()
+        for epoch in range(epochs):
+            order = torch.randperm(len(X), generator=generator).to(self.device) if batch_size < len(X) else torch.arange(len(X), device=self.device)
+            for start in range(0, len(X), batch_size):
+                # the models are independent, so summing their losses gives each one its own gradient
+                loss = (self.__losses(criterion, X, y, order[start:start + batch_size], masks) * active).sum()
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+            if not early_stopping: continue
+            with torch.no_grad():
+                val_loss = self.__losses(criterion, X, y, torch.arange(len(X), device=self.device), val_masks)
+                improved = active & (val_loss < best_loss)
+                best_loss = torch.where(improved, val_loss, best_loss)
+                for parameter, saved in zip(self.parameters(), best):
+                    saved[improved] = parameter[improved]
+                stale = torch.where(improved, 0, stale + 1)
+                active &= stale < patience
+            if not active.any(): break
+        if early_stopping:
+            with torch.no_grad():
+                for parameter, saved in zip(self.parameters(), best):
+                    parameter.copy_(saved)
+        return self
+    def predict(self, X):
+        """(n_models, rows) predictions, every model on every row"""
+        X = X.to(self.device)
+        was_training = self.training
+        self.eval()
+        with torch.inference_mode():
+            y_pred = self(X)
+        self.train(was_training)
+        return y_pred.argmax(2).cpu().numpy()
@@ -1,4 +1,4 @@
-DROP TABLE IF EXISTS player, team, position, playerteam, injury, precipitation, game, gameplayer, feature_support;
+DROP TABLE IF EXISTS player, team, position, playerteam, injury, precipitation, game, gameplayer, feature_support, venue, ingest_checkpoint, teamgame;
 
 -- this will include coaches
 CREATE TABLE player (
@@ -83,6 +83,16 @@ CREATE TABLE game(
     FOREIGN KEY (away_team_id) REFERENCES team(id)
 );
 
+-- geocoded stadiums, so the scraper only asks Nominatim about each venue once
+CREATE TABLE IF NOT EXISTS venue(
+    name varchar(150) PRIMARY KEY, -- "stadium city state", the string that gets geocoded
+    stadium varchar(50),
+    city varchar(50),
+    state char(2),
+    lat real,
+    lon real
+);
+
 CREATE TABLE gameplayer(
     game int,
     player int,
@@ -159,6 +169,44 @@ CREATE TABLE gameplayer(
     longPunt real
 );
 
+-- which events build_db.py has completely written, so an interrupted run can pick up where it left off
+CREATE TABLE IF NOT EXISTS ingest_checkpoint(
+    event_id int PRIMARY KEY,
+    season int,
+    status varchar(10), -- 'done' once the game and all of its boxscores are committed
+    updated timestamp DEFAULT now()
+);
+
+-- one row per team per game with the team's boxscore stats summed up, written by build_db.py along with each game
+-- (python build_db.py 2015-2023 --backfill-teamgame fills it in for games that are already in the db).
+-- the summed columns are nflscraper's rollup features, keep the two lists in sync
+CREATE TABLE IF NOT EXISTS teamgame(
+    game int,
+    team int,
+    is_home boolean,
+    gameday date,
+    season int,
+    score int,
+    third_dwn_pct real,
+    adjQBR real,
+    passingYards real,
+    rushingYards real,
+    fumbles real,
+    totalTackles real,
+    sacks real,
+    interceptions real,
+    QBHits real,
+    PRIMARY KEY(game, team),
+    FOREIGN KEY (game) REFERENCES game(id),
+    FOREIGN KEY (team) REFERENCES team(id)
+);
+CREATE INDEX IF NOT EXISTS teamgame_team_gameday ON teamgame(team, gameday);
+
+-- prior game lookups (generate_csv.py) walk each team's games in date order, and sum boxscores per team per game
+CREATE INDEX IF NOT EXISTS game_home_team_gameday ON game(home_team_id, gameday);
+CREATE INDEX IF NOT EXISTS game_away_team_gameday ON game(away_team_id, gameday);
+CREATE INDEX IF NOT EXISTS gameplayer_game_team ON gameplayer(game, team);
+
 CREATE TABLE feature_support(
     id serial PRIMARY KEY,
     display_name varchar(30),
@@ -2,8 +2,7 @@
 # result: unsuccessful (all predictions are 1)
 import sys 
 
-from train_model import preprocess
-import pandas as pd
+from training_data import load_training_data
 from sklearn.model_selection import KFold
 
 import torch
@@ -54,8 +53,7 @@ def main():
     else:
         print("Usage: python train_model.py [train.csv]")
         sys.exit(1)
-    csv_data = pd.read_csv(fpath)
-    X, y = preprocess(csv_data)
+    X, y = load_training_data(fpath)
 
     svm = SVM(len(X.columns), device=device)
 
@@ -1,14 +1,16 @@
-import sys
-import pandas as pd
+import sys, argparse
 import numpy as np
 from tqdm import tqdm
-from neural_network import NN
+from neural_network import NN, BatchedNN
+from training_data import load_training_data
+from kernel_cache import kernel_cache
 
-from sklearn.impute import KNNImputer
 from sklearn import tree
 from sklearn.svm import SVC
 from sklearn.model_selection import KFold
 from sklearn.metrics import f1_score, accuracy_score
+from threadpoolctl import threadpool_limits
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import torch
 import torch.nn as nn
@@ -17,71 +19,142 @@ import torch.optim as optim
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"Device: {device}")
 
-def preprocess(df):
-    # 1. Drop game_ids
-    df.drop('game_id', axis=1, inplace=True)
-    # 2. Change labels from Home | Away to -1 | 1, respectively
-    df["label"] = df["label"].map({"Home": 0, "Away": 1})
-
-    # TODO: test that this actually works
-    imputer = KNNImputer(n_neighbors=10, weights="uniform")
-    if 'precip_severity' in df.columns: df["precip_severity"] = imputer.fit_transform(df[["precip_severity"]])
-    if 'temperature' in df.columns: df["temperature"] = imputer.fit_transform(df[["temperature"]])
-
-
-    # 3. normalize columns
-    data = df.drop(['label'], axis=1)
-    for column in data.columns:
-        data[column] = (data[column] - data[column].min()) / (data[column].max() - data[column].min())
-
-    return data, df["label"]
-
+model_names = ["Decision Tree", "SVM", "Neural Network"]
+# minibatch Adam that stops once a held out 10% of the fold stops improving, instead of 1000 full batch SGD steps
+nn_params = {"lr": 0.01, "epochs": 200, "batch_size": 64, "optimizer": "adam", "validation_split": 0.1, "patience": 10}
+# set by init_worker in each process of the pool (or by main when running serially)
+X, y, worker_device, thread_limits, kernels = None, None, device, None, None
+
+def init_worker(path: str, threads: int = None, use_device=None, precompute_kernel: bool = False, kernel_dir: str = None):
+    """Loads the data once per worker process and pins BLAS/OpenMP and torch to `threads` threads, so
+    n workers don't each start a thread per core and fight over them. With precompute_kernel, the SVM's
+    kernel matrix is computed once for all of the data (kernel_cache) and every fold slices its rows out of it."""
+    global X, y, worker_device, thread_limits, kernels
+    if threads is not None:
+        thread_limits = threadpool_limits(limits=threads)
+        torch.set_num_threads(threads)
+    # an npy export is memory-mapped, so every worker shares the same copy of it
+    X, y = load_training_data(path)
+    worker_device = use_device if use_device is not None else torch.device("cpu")
+    kernels = kernel_cache(X, kernel_dir) if precompute_kernel else None
+    # (with a kernel_dir, the first process writes the matrix and the rest just map it)
+    if kernels is not None: kernels.kernel()
+
+def cv_splits(n_rows: int, repeats: int = 15, folds: int = 5, seed: int = 0) -> list[tuple]:
+    """[(repeat, fold, train_idx, test_idx)], a fresh shuffle per repeat (seeded by seed + repeat, so reruns get the same folds)"""
+    splits = []
+    for repeat in range(repeats):
+        kf = KFold(n_splits=folds, shuffle=True, random_state=seed + repeat)
+        for fold, (train_idx, test_idx) in enumerate(kf.split(np.zeros(n_rows))):
+            splits.append((repeat, fold, train_idx, test_idx))
+    return splits
+
+def fit_predict(model_name: str, train_idx, test_idx, seed: int):
+    """Trains a fresh model on one fold and returns its predictions for the fold's test rows"""
+    X_train, X_test = X.iloc[train_idx], X.iloc[test_idx]
+    y_train = y.iloc[train_idx]
+    match model_name:
+        case "Decision Tree":
+            model = tree.DecisionTreeClassifier(random_state=seed)
+            return model.fit(X_train, y_train).predict(X_test)
+        case "SVM":
+            if kernels is None: return SVC().fit(X_train, y_train).predict(X_test)
+            # SVC()'s rbf kernel, though gamma="scale" comes from all of the data instead of just the training rows
+            K_train, K_test = kernels.fold(train_idx, test_idx)
+            return SVC(kernel="precomputed").fit(K_train, y_train).predict(K_test)
+        case "Neural Network":
+            torch.manual_seed(seed)
+            model = NN(len(X.columns), device=worker_device)
+            model.fit(torch.tensor(X_train.values, dtype=torch.float32), torch.tensor(y_train.values, dtype=torch.int64),
+                      **nn_params, seed=seed)
+            return model.predict(torch.tensor(X_test.values, dtype=torch.float32))
+    raise ValueError(f"Unknown model {model_name}")
+
+def fit_predict_batched(splits: list[tuple], seed: int) -> list:
+    """Trains the neural network for every (repeat, fold) at once (see BatchedNN), and returns each
+    one's predictions for its fold's test rows"""
+    torch.manual_seed(seed)
+    masks = np.zeros((len(splits), len(X)), dtype=bool)
+    for i, (_, _, train_idx, _) in enumerate(splits): masks[i, train_idx] = True
+    model = BatchedNN(len(splits), len(X.columns), device=worker_device)
+    features = torch.tensor(X.values, dtype=torch.float32)
+    model.fit(features, torch.tensor(y.values, dtype=torch.int64), masks, **nn_params, seed=seed)
+    pred = model.predict(features)
+    return [pred[i, test_idx] for i, (_, _, _, test_idx) in enumerate(splits)]
+
+def run_task(repeat: int, fold: int, model_name: str, train_idx, test_idx, seed: int) -> tuple:
+    """One (repeat, fold, model) of the cross validation: (f1, accuracy) on the fold's test rows"""
+    pred = fit_predict(model_name, train_idx, test_idx, seed)
+    y_test = y.iloc[test_idx]
+    return f1_score(y_test, pred), accuracy_score(y_test, pred)
+
+def cross_validate(path: str, repeats: int = 15, folds: int = 5, seed: int = 0, processes: int = 1, 
+                   threads: int = 1, models: list[str] = model_names, batched_nn: bool = True,
+                   precompute_kernel: bool = False, kernel_dir: str = None) -> dict:
+    """Repeated k-fold cross validation of every model, spread over `processes` worker processes.
+    With batched_nn, the neural networks for all of the folds are trained together here instead (fit_predict_batched).
+    With precompute_kernel, the SVM's kernel matrix is computed once per process (or once, into kernel_dir) instead of per fold.
+    Returns {model: {"f1": [...], "acc": [...]}} with the scores in (repeat, fold) order whatever order they finish in."""
+    precompute_kernel = precompute_kernel and "SVM" in models
+    # (running serially, the main process keeps all of its threads.) With a pool, the SVMs are all fit in the workers,
+    # so the main process only computes the kernel to write kernel_dir's file for them, otherwise they compute their own
+    init_worker(path, threads=None if processes == 1 else threads, use_device=device,
+                precompute_kernel=precompute_kernel and (processes == 1 or kernel_dir is not None), kernel_dir=kernel_dir)
+    splits = cv_splits(len(X), repeats, folds, seed)
+    results = {model_name: {"f1": [], "acc": []} for model_name in models}
+    if batched_nn and "Neural Network" in models:
+        for (_, _, _, test_idx), pred in zip(splits, fit_predict_batched(splits, seed)):
+            results["Neural Network"]["f1"].append(f1_score(y.iloc[test_idx], pred))
+            results["Neural Network"]["acc"].append(accuracy_score(y.iloc[test_idx], pred))
+        models = [model_name for model_name in models if model_name != "Neural Network"]
+    # every task gets its own seed, so the models don't depend on which worker (or in what order) they run
+    tasks = [(repeat, fold, model_name, train_idx, test_idx, seed + repeat * folds + fold)
+             for repeat, fold, train_idx, test_idx in splits for model_name in models]
+    scores = [None] * len(tasks)
+    if processes == 1:
+        for i, task in enumerate(tqdm(tasks)):
+            scores[i] = run_task(*task)
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=(path, threads, None, precompute_kernel, kernel_dir)) as pool:
+            futures = {pool.submit(run_task, *task): i for i, task in enumerate(tasks)}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                scores[futures[future]] = future.result()
+    for (_, _, model_name, *_), (f1, acc) in zip(tasks, scores):
+        results[model_name]["f1"].append(f1)
+        results[model_name]["acc"].append(acc)
+    return results
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Repeated k-fold cross validation of the decision tree, SVM and neural network")
+    parser.add_argument("path", help="training data from generate_csv.py (csv, parquet, feather or npy)")
+    parser.add_argument("--repeats", type=int, default=15)
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0, help="seeds the folds and the models, so runs are reproducible")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes to spread the (repeat, fold, model) fits over")
+    parser.add_argument("--threads", type=int, default=1, help="BLAS/torch threads per worker process")
+    parser.add_argument("--per-fold-nn", action="store_true",
+                        help="train the neural network fold by fold like the other models, instead of all folds at once")
+    parser.add_argument("--precompute-kernel", action="store_true",
+                        help="compute the SVM's kernel matrix once and slice each fold out of it (gamma then comes from all of the data)")
+    parser.add_argument("--kernel-dir", default=None, help="with --precompute-kernel, memory-map the kernel matrix from .npy files here")
+    return parser.parse_args(argv)
 
 def main():
-    if len(sys.argv) > 1:
-        fpath = sys.argv[1]
-    else:
-        print("Usage: python train_model.py [train.csv]")
+    if len(sys.argv) < 2:
+        print("Usage: python train_model.py [train.csv | train.parquet | train.feather | train.npy] [--processes N]")
         sys.exit(1)
-    csv_data = pd.read_csv(fpath)
-    X, y = preprocess(csv_data)
-
-    # models
-    dt, dt_score, dt_acc = tree.DecisionTreeClassifier(), [], []
-    svm, svm_score, svm_acc = SVC(), [], []
-    nn, nn_score, nn_acc = NN(len(X.columns), device=device), [], []
+    args = parse_args(sys.argv[1:])
 
     # repeated five fold cross validation to smooth the accuracy measure between runs
     # NOTE: non-repeating five fold cross validation is highly sensitive to the split in the data, 
     #   so new shuffles each time helps give more consistent results between runs
-    for j in tqdm(range(15), position=0):
-        kf = KFold(n_splits=5, shuffle=True)
-        for i, (train_idx, test_idx) in tqdm(enumerate(kf.split(X)), total=5, position=1, leave=False):
-            X_train, X_test = X.iloc[train_idx], X.iloc[test_idx]
-            y_train, y_test = y.iloc[train_idx], y.iloc[test_idx]
-
-            dt.fit(X_train, y_train)
-            dt_pred = dt.predict(X_test)
-            dt_score.append(f1_score(y_test, dt_pred))
-            dt_acc.append(accuracy_score(y_test, dt_pred))
-
-            svm.fit(X_train, y_train)
-            svm_pred = svm.predict(X_test)
-            svm_score.append(f1_score(y_test, svm_pred))
-            svm_acc.append(accuracy_score(y_test, svm_pred))
-
-            nn.fit(torch.tensor(X_train.values, dtype=torch.float32), torch.tensor(y_train.values, dtype=torch.int64))
-            nn_pred = nn.predict(torch.tensor(X_test.values, dtype=torch.float32))
-            nn_score.append(f1_score(y_test, nn_pred))
-            nn_acc.append(accuracy_score(y_test, nn_pred))
+    results = cross_validate(args.path, args.repeats, args.folds, args.seed, args.processes, args.threads, 
+                             batched_nn=not args.per_fold_nn, precompute_kernel=args.precompute_kernel, kernel_dir=args.kernel_dir)
 
-    print(f"Decision Tree F1: {np.mean(dt_score):.4f} +/- {np.std(dt_score):.4f}")
-    print(f"Decision Tree Acc: {np.mean(dt_acc):.4f} +/- {np.std(dt_acc):.4f}")
-    print(f"SVM F1: {np.mean(svm_score):.4f} +/- {np.std(svm_score):.4f}")
-    print(f"SVM Acc: {np.mean(svm_acc):.4f} +/- {np.std(svm_acc):.4f}")
-    print(f"Neural Network F1: {np.mean(nn_score):.4f} +/- {np.std(nn_score):.4f}")
-    print(f"Neural Network Acc: {np.mean(nn_acc):.4f} +/- {np.std(nn_acc):.4f}")
+    for model_name, scores in results.items():
+        print(f"{model_name} F1: {np.mean(scores['f1']):.4f} +/- {np.std(scores['f1']):.4f}")
+        print(f"{model_name} Acc: {np.mean(scores['acc']):.4f} +/- {np.std(scores['acc']):.4f}")
 
 if __name__ == "__main__":
     main()
-    sys.exit(0)
\ No newline at end of file
+    sys.exit(0)
@@ -0,0 +1,136 @@
+"""
+============================
+===   training_data.py   ===
+============================
+Reading and writing the training data generate_csv.py exports, in whichever format it was exported as:
+    .csv: what it's always been, one row per game with string labels
+    .parquet/.feather: the same rows with explicit dtypes (float64 features, int64 game_id, int8 label) and the
+        feature configuration in the file's metadata. Needs pyarrow.
+    .npy (a directory): X.npy (float32, already preprocessed), y.npy (int8), game_id.npy and meta.json. These are
+        opened memory-mapped, so loading is instant and every process that opens them shares the same pages.
+"""
+import os, json
+import numpy as np
+import pandas as pd
+from sklearn.impute import KNNImputer
+
+labels = {"Home": 0, "Away": 1}
+
+def preprocess(df):
+    # 1. Drop game_ids (if they're still there)
+    if 'game_id' in df.columns: df.drop('game_id', axis=1, inplace=True)
+    # 2. Change labels from Home | Away to 0 | 1, respectively (columnar exports already have them as numbers)
+    if not pd.api.types.is_numeric_dtype(df["label"]): df["label"] = df["label"].map(labels)
+
+    # TODO: test that this actually works
+    imputer = KNNImputer(n_neighbors=10, weights="uniform")
+    if 'precip_severity' in df.columns: df["precip_severity"] = imputer.fit_transform(df[["precip_severity"]])
+    if 'temperature' in df.columns: df["temperature"] = imputer.fit_transform(df[["temperature"]])
+
+
+    # 3. normalize columns
+    data = df.drop(['label'], axis=1)
+    for column in data.columns:
+        data[column] = (data[column] - data[column].min()) / (data[column].max() - data[column].min())
+
+    return data, df["label"]
+
+def typed(training: pd.DataFrame) -> pd.DataFrame:
+    """The export with explicit dtypes: float64 features, int64 game_id and the label as an int8 (see labels)"""
+    features = training.drop(columns=["game_id", "label"]).astype("float64")
+    return features.assign(game_id=training["game_id"].astype("int64"), label=training["label"].map(labels).astype("int8"))
+
+def arrow_table(training: pd.DataFrame, config: dict):
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError("Writing parquet/feather needs pyarrow: pip install pyarrow")
+    table = pa.Table.from_pandas(typed(training), preserve_index=False)
+    return table.replace_schema_metadata((table.schema.metadata or {}) |
+                                         {b"nflscraper": json.dumps({"config": config, "labels": labels}).encode()})
+
+def write_training_data(training: pd.DataFrame, path: str, config: dict):
+    """Writes generate_csv.py's rows to path, in the format its extension asks for"""
+    extension = os.path.splitext(path)[1]
+    if extension == ".parquet":
+        import pyarrow.parquet as pq
+        pq.write_table(arrow_table(training, config), path)
+    elif extension == ".feather":
+        import pyarrow.feather as feather
+        feather.write_feather(arrow_table(training, config), path)
+    elif extension == ".npy":
+        frame = typed(training)
+        game_ids = frame.pop("game_id")
+        X, y = preprocess(frame)
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "X.npy"), np.ascontiguousarray(X.to_numpy(dtype=np.float32)))
+        np.save(os.path.join(path, "y.npy"), y.to_numpy(dtype=np.int8))
+        np.save(os.path.join(path, "game_id.npy"), game_ids.to_numpy())
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"config": config, "labels": labels, "columns": list(X.columns), "preprocessed": True}, f)
+    else:
+        training.to_csv(path, index=False)
+
+def write_chunks(rows, path: str, config: dict, chunk_rows: int = 10000, append: bool = False, columns: list = None) -> list[int]:
+    """Writes rows (dicts, e.g. from a generator) to path chunk_rows at a time, so they never all have to be in
+    memory. csv can be appended to, parquet/feather are written a row group/record batch per chunk. An npy export
+    is preprocessed as a whole, so it can't be written this way. If there are no rows at all (and nothing to append
+    to), an empty export with just the columns is written. Returns the game ids that were written."""
+    extension = os.path.splitext(path)[1]
+    if extension == ".npy":
+        raise ValueError("npy exports are preprocessed all at once, they can't be written in chunks")
+    writer, schema, started, game_ids, chunk = None, None, append, [], []
+    def flush():
+        nonlocal writer, schema, started
+        frame = pd.DataFrame(chunk)
+        game_ids.extend(int(game) for game in frame["game_id"])
+        if extension == ".csv":
+            frame.to_csv(path, mode="a" if started else "w", header=not started, index=False)
+        else:
+            import pyarrow as pa, pyarrow.parquet as pq
+            table = arrow_table(frame, config)
+            if writer is None:
+                # the first chunk decides the schema, later ones are cast to it
+                schema = table.schema
+                writer = pq.ParquetWriter(path, schema) if extension == ".parquet" else pa.ipc.new_file(path, schema)
+            writer.write_table(table.cast(schema))
+        started = True
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            flush()
+            chunk = []
+    if len(chunk) > 0: flush()
+    elif not started:
+        # e.g. a season with no games yet: still leave an (empty) export behind, like writing a whole DataFrame would
+        chunk = pd.DataFrame(columns=columns if columns is not None else ["game_id", "label"])
+        flush()
+    if writer is not None: writer.close()
+    return game_ids
+
+def read_metadata(path: str) -> dict:
+    """The feature configuration (and label mapping) a parquet/feather/npy export was made with, None for a csv"""
+    extension = os.path.splitext(os.path.normpath(path))[1]
+    if extension == ".npy":
+        with open(os.path.join(path, "meta.json")) as f:
+            return json.load(f)
+    if extension in (".parquet", ".feather"):
+        import pyarrow.parquet as pq, pyarrow.feather as feather
+        schema = pq.read_schema(path) if extension == ".parquet" else feather.read_table(path, memory_map=True).schema
+        return json.loads(schema.metadata[b"nflscraper"])
+    return None
+
+def load_training_data(path: str):
+    """Returns (X, y) ready for training from any export. An npy export is memory-mapped rather than read,
+    and was preprocessed when it was written, so nothing gets copied."""
+    extension = os.path.splitext(os.path.normpath(path))[1]
+    if extension == ".npy":
+        meta = read_metadata(path)
+        X = np.load(os.path.join(path, "X.npy"), mmap_mode="r")
+        y = np.load(os.path.join(path, "y.npy"), mmap_mode="r")
+        return pd.DataFrame(X, columns=meta["columns"], copy=False), pd.Series(y, name="label", copy=False)
+    if extension == ".parquet":
+        return preprocess(pd.read_parquet(path))
+    if extension == ".feather":
+        return preprocess(pd.read_feather(path))
+    return preprocess(pd.read_csv(path))